@@ -3,12 +3,40 @@
 LPG Proxy - Path-based reverse proxy with path rewriting support
 Version: 2.2.0
 """
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import urllib.request
-import urllib.error
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+import http.client
 import json
 import logging
+import math
 import os
+import queue
+import threading
+import time
+import errno
+import select
+import signal
+import subprocess
+import sys
+import selectors
+import fcntl
+import itertools
+import random
+import socket
+import asyncio
+import hashlib
+import ipaddress
+import bisect
+import re
+import zlib
+import tempfile
+from http import HTTPStatus
+from types import MappingProxyType
+from collections import OrderedDict
+from collections.abc import Mapping
+from http.cookies import SimpleCookie, CookieError
+from urllib.parse import parse_qs
+import urllib.request
+from email.utils import parsedate_to_datetime
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,15 +45,2913 @@ logger = logging.getLogger(__name__)
 # 設定ファイルのパス
 CONFIG_FILE = '/opt/lpg/src/config.json'
 
-class LPGProxyHandler(BaseHTTPRequestHandler):
-    def load_config(self):
-        """設定ファイルを読み込む"""
+# 設定ファイルの変更チェック間隔（秒）
+CONFIG_CHECK_INTERVAL = 1.0
+
+# ワーカープールのデフォルト値（config.json の options で上書き可能）
+DEFAULT_PROXY_WORKERS = 32
+DEFAULT_PROXY_QUEUE_SIZE = 64
+DEFAULT_PROXY_RETRY_AFTER = 1
+
+# バックエンド接続プールのデフォルト値（options で上書き可能）
+DEFAULT_POOL_MAX_IDLE = 8
+DEFAULT_POOL_MAX_TOTAL = 64
+DEFAULT_POOL_IDLE_TIMEOUT = 30
+
+# リクエストボディの転送単位と上限（上限はルールの max_body_size で上書き可能）
+REQUEST_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_LINE = 1024
+DEFAULT_MAX_BODY_SIZE = 100 * 1024 * 1024
+# chunked のサイズ行（16進数字と拡張だけを認め、CRLF で終わるもの）
+CHUNK_SIZE_PATTERN = re.compile(rb'([0-9A-Fa-f]{1,16})[ \t]*(?:;[^\r\n]*)?\r\n')
+
+# レスポンスボディの中継（大きなボディは os.splice でカーネル内転送）
+RELAY_BUFFER_SIZE = 64 * 1024
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+SPLICE_MIN_SIZE = 128 * 1024
+SPLICE_PIPE_SIZE = 256 * 1024
+
+# アクティブヘルスチェックのデフォルト値（ルールの health_check で上書き可能）
+DEFAULT_HEALTH_INTERVAL = 5
+DEFAULT_HEALTH_TIMEOUT = 2
+DEFAULT_HEALTH_RISE = 2
+DEFAULT_HEALTH_FALL = 3
+DEFAULT_HEALTH_JITTER = 1
+
+# サーキットブレーカーのデフォルト値（options/ルールの circuit_breaker で上書き可能）
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+# Backend.begin() が返す許可（通常のリクエストか、半開状態での試験リクエストか）
+CIRCUIT_PASS = 'pass'
+CIRCUIT_TRIAL = 'trial'
+DEFAULT_CIRCUIT_FAILURES = 5
+DEFAULT_CIRCUIT_COOLDOWN = 10
+DEFAULT_CIRCUIT_HALF_OPEN = 1
+
+# レスポンスキャッシュ（ルールの cache で有効化、メモリ上限は options.cache_memory_size）
+DEFAULT_CACHE_MEMORY_SIZE = 64 * 1024 * 1024
+DEFAULT_CACHE_MAX_ENTRY_SIZE = 1024 * 1024
+CACHE_ENTRY_OVERHEAD = 256
+CACHEABLE_STATUSES = frozenset([200, 203, 204, 300, 301, 308, 404, 410])
+# キャッシュキーの正規化でデコードしてよい文字（RFC 3986 の unreserved）
+UNRESERVED_CHARACTERS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+PERCENT_ENCODED_PATTERN = re.compile(r'%([0-9A-Fa-f]{2})')
+# 期限切れエントリのバックグラウンド再検証（キューが満杯なら再検証を見送る）
+REVALIDATE_WORKERS = 4
+REVALIDATE_QUEUE_SIZE = 64
+
+# ディスクキャッシュ（大きなボディ用の第2層、容量は options.cache_disk_size、0 で無効）
+DEFAULT_CACHE_DIR = '/var/cache/lpg'
+DEFAULT_CACHE_DISK_SIZE = 512 * 1024 * 1024
+DEFAULT_CACHE_MAX_DISK_ENTRY_SIZE = 64 * 1024 * 1024
+# index.json の書き出しをまとめる間隔（秒）
+DISK_CACHE_INDEX_DELAY = 2
+
+# 同一 GET の同時リクエストをまとめる（ルールの coalesce で有効化）
+COALESCE_WAIT_TIMEOUT = 30
+COALESCE_MAX_BUFFER = 8 * 1024 * 1024
+
+# Upgrade（WebSocket など）のトンネル（options の max_tunnels / tunnel_idle_timeout で上書き可能）
+DEFAULT_MAX_TUNNELS = 256
+DEFAULT_TUNNEL_IDLE_TIMEOUT = 300
+TUNNEL_BUFFER_SIZE = 64 * 1024
+
+# セッションアフィニティ（ルールの affinity で有効化）
+DEFAULT_AFFINITY_COOKIE = 'lpg_affinity'
+DEFAULT_AFFINITY_REPLICAS = 100
+MAX_AFFINITY_PINS = 10000
+SOCKETIO_SID_PATTERN = re.compile(rb'"sid"\s*:\s*"([^"]+)"')
+
+# レート制限（options.rate_limit とルールの rate_limit で有効化）
+DEFAULT_RATE_LIMIT_TABLE_SIZE = 10000
+
+# gzip 圧縮（ルールの compress で有効化）
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_COMPRESS_TYPES = (
+    'text/', 'application/javascript', 'application/json', 'application/xml',
+    'application/manifest+json', 'image/svg+xml',
+)
+DEFAULT_COMPRESS_CACHE_SIZE = 8 * 1024 * 1024
+
+# 管理用エンドポイント（ループバックのみで待ち受け）
+DEFAULT_CONTROL_PORT = 9180
+
+# アクセスログ（options.access_log で上書き可能、path を空にするとロガーへ出力）
+DEFAULT_ACCESS_LOG_PATH = '/var/log/lpg_access.log'
+DEFAULT_ACCESS_LOG_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_ACCESS_LOG_MAX_FILES = 5
+DEFAULT_ACCESS_LOG_ROTATE_INTERVAL = 86400
+DEFAULT_ACCESS_LOG_QUEUE_SIZE = 10000
+DEFAULT_ACCESS_LOG_POLICY = 'drop'
+ACCESS_LOG_BATCH_SIZE = 256
+
+# /__lpg/metrics のレイテンシヒストグラムのバケット（秒、固定）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# マルチプロセスモード（options.workers または LPG_PROXY_WORKERS が 2 以上で有効）
+# ワーカー i の管理用エンドポイントは control_port + 1 + i で待ち受ける
+WORKER_RESTART_DELAY = 5
+WORKER_MIN_UPTIME = 10
+WORKER_STOP_TIMEOUT = 10
+
+# グレースフルリロード（SIGHUP）: 待ち受けソケットを後継プロセスに引き継ぎ、
+# 旧プロセスは処理中の接続を options.drain_timeout 秒まで待ってから終了する
+DEFAULT_DRAIN_TIMEOUT = 60
+RELOAD_READY_TIMEOUT = 15
+CONTROL_BIND_TIMEOUT = 10
+
+# 冪等メソッド（再利用接続が切れていた場合に再送してよいもの）
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+# クライアント keep-alive のアイドルタイムアウト（秒）
+DEFAULT_KEEPALIVE_TIMEOUT = 15
+# アイドルな keep-alive 接続がワーカー待ちの有無を確認する間隔（秒）
+KEEPALIVE_POLL_INTERVAL = 0.1
+
+# バックエンドとの通信タイムアウト（秒、options/ルールの timeouts で上書き可能）
+BACKEND_TIMEOUT = 30
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = BACKEND_TIMEOUT
+DEFAULT_TOTAL_TIMEOUT = 0
+
+# 冪等メソッドの再試行（options/ルールの retries、全体の上限は options.retry_budget）
+DEFAULT_RETRY_ATTEMPTS = 1
+DEFAULT_RETRY_STATUSES = (502, 503, 504)
+DEFAULT_RETRY_BUDGET_RATIO = 0.2
+DEFAULT_RETRY_BUDGET_MIN_PER_SECOND = 3
+
+# asyncio エンジンの設定
+MAX_HEADER_BYTES = 64 * 1024
+RELAY_CHUNK_SIZE = 64 * 1024
+
+# プロキシが付け直すヘッダー
+PROXY_HEADERS = frozenset([
+    'x-forwarded-for', 'x-forwarded-host', 'x-forwarded-proto', 'x-real-ip', 'x-original-path',
+])
+
+# 転送してはいけないホップバイホップヘッダー
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade',
+])
+
+# クライアントへのレスポンスでコピーしないヘッダー（Content-Encoding はボディと一緒にそのまま渡す）
+RESPONSE_SKIP_HEADERS = HOP_BY_HOP_HEADERS | {'content-length'}
+
+# キャッシュの再検証時に付け替える条件付きリクエストヘッダー
+CONDITIONAL_HEADERS = frozenset([
+    'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range',
+    'cache-control', 'pragma',
+])
+
+# バックエンドへのリクエストでコピーしないヘッダー
+BACKEND_SKIP_HEADERS = HOP_BY_HOP_HEADERS | PROXY_HEADERS | {'host', 'content-length', 'expect'}
+REVALIDATE_SKIP_HEADERS = BACKEND_SKIP_HEADERS | CONDITIONAL_HEADERS
+
+def freeze(value):
+    """dict/list を読み取り専用の MappingProxyType/tuple に再帰的に変換する"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+class RouteError(Exception):
+    """ルーティングに失敗した場合に送出する（status はクライアントに返すコード）"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class CircuitBreakerSpec:
+    """サーキットブレーカーの閾値（options と各ルールの circuit_breaker で設定）"""
+    __slots__ = ('failures', 'cooldown', 'half_open_requests')
+
+    def __init__(self, spec):
+        self.failures = int(spec.get('failures', DEFAULT_CIRCUIT_FAILURES))
+        self.cooldown = float(spec.get('cooldown', DEFAULT_CIRCUIT_COOLDOWN))
+        self.half_open_requests = int(spec.get('half_open_requests', DEFAULT_CIRCUIT_HALF_OPEN))
+
+class Backend:
+    """バックエンドエンドポイント (ip, port) ごとの共有状態"""
+    __slots__ = ('ip', 'port', 'outstanding', 'healthy', 'checked', 'health_successes',
+                 'health_failures', 'last_check', 'last_error', 'circuit', 'circuit_until',
+                 'consecutive_failures', 'trials', 'trial_limit', '_lock')
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.outstanding = 0
+        self.healthy = True
+        self.checked = False
+        self.health_successes = 0
+        self.health_failures = 0
+        self.last_check = None
+        self.last_error = None
+        self.circuit = CIRCUIT_CLOSED
+        self.circuit_until = 0.0
+        self.consecutive_failures = 0
+        self.trials = 0
+        self.trial_limit = DEFAULT_CIRCUIT_HALF_OPEN
+        self._lock = threading.Lock()
+
+    def available(self):
+        """ルーティング対象にしてよいか（ヘルスチェックとサーキットの状態）"""
+        if not self.healthy:
+            return False
+        if self.circuit == CIRCUIT_HALF_OPEN:
+            # 試験リクエストの枠が埋まっている間は他のバックエンドを選ばせる
+            return self.trials < self.trial_limit
+        return self.circuit != CIRCUIT_OPEN or time.monotonic() >= self.circuit_until
+
+    def begin(self, breaker):
+        """リクエスト開始。通せる場合は end() に渡す許可（CIRCUIT_PASS/CIRCUIT_TRIAL）、
+        サーキットが開いていて通せない場合は None を返す"""
+        with self._lock:
+            if self.circuit == CIRCUIT_OPEN:
+                if time.monotonic() < self.circuit_until:
+                    return None
+                # クールダウン終了：試験的なリクエストだけを通す
+                self.circuit = CIRCUIT_HALF_OPEN
+                self.trials = 0
+                self.trial_limit = breaker.half_open_requests
+                logger.info(f"Circuit for {self} is half-open")
+            permit = CIRCUIT_PASS
+            if self.circuit == CIRCUIT_HALF_OPEN:
+                if self.trials >= breaker.half_open_requests:
+                    return None
+                self.trials += 1
+                permit = CIRCUIT_TRIAL
+            self.outstanding += 1
+            return permit
+
+    def end(self, permit, ok, breaker):
+        """リクエスト終了。permit は begin() の戻り値、ok=True/False でバックエンドの成否を記録する
+        （None は対象外）"""
+        with self._lock:
+            self.outstanding -= 1
+            if permit == CIRCUIT_TRIAL and self.circuit == CIRCUIT_HALF_OPEN and self.trials > 0:
+                self.trials -= 1
+            if ok is None:
+                return
+            if ok:
+                self.consecutive_failures = 0
+                if self.circuit != CIRCUIT_CLOSED:
+                    self.circuit = CIRCUIT_CLOSED
+                    logger.info(f"Circuit for {self} closed")
+                return
+            self.consecutive_failures += 1
+            if (self.circuit == CIRCUIT_HALF_OPEN
+                    or (self.circuit == CIRCUIT_CLOSED
+                        and self.consecutive_failures >= breaker.failures)):
+                self.circuit = CIRCUIT_OPEN
+                self.circuit_until = time.monotonic() + breaker.cooldown
+                logger.warning(f"Circuit for {self} opened after "
+                               f"{self.consecutive_failures} consecutive failures")
+
+    def record_probe(self, ok, error, rise, fall):
+        """ヘルスチェック結果を反映する（rise 回連続成功で復帰、fall 回連続失敗で除外）"""
+        with self._lock:
+            self.last_check = time.time()
+            self.last_error = error
+            if ok:
+                self.health_failures = 0
+                self.health_successes += 1
+                if not self.healthy and self.health_successes >= rise:
+                    self.healthy = True
+                    logger.info(f"Backend {self} is healthy again")
+            else:
+                self.health_successes = 0
+                self.health_failures += 1
+                if self.healthy and self.health_failures >= fall:
+                    self.healthy = False
+                    logger.warning(f"Backend {self} marked unhealthy: {error}")
+
+    def reset_health(self):
+        """ヘルスチェック対象から外れたときに状態を初期化する"""
+        with self._lock:
+            self.healthy = True
+            self.checked = False
+            self.health_successes = 0
+            self.health_failures = 0
+            self.last_error = None
+
+    def health(self):
+        return {
+            'healthy': self.healthy,
+            'checked': self.checked,
+            'last_check': self.last_check,
+            'last_error': self.last_error,
+            'circuit': self.circuit,
+        }
+
+    def __str__(self):
+        return f"{self.ip}:{self.port}"
+
+class BackendRegistry:
+    """Backend を (ip, port) ごとに1つだけ生成し、設定の再読み込みをまたいで共有する"""
+
+    def __init__(self):
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def get(self, ip, port):
+        key = (ip, port)
+        backend = self._backends.get(key)
+        if backend is None:
+            with self._lock:
+                backend = self._backends.setdefault(key, Backend(ip, port))
+        return backend
+
+    def stats(self):
+        return {
+            str(b): {
+                'outstanding': b.outstanding,
+                'circuit': b.circuit,
+                'consecutive_failures': b.consecutive_failures,
+            }
+            for b in list(self._backends.values())
+        }
+
+    def health(self):
+        return {str(b): b.health() for b in list(self._backends.values())}
+
+backends = BackendRegistry()
+
+class RoundRobinBalancer:
+    """ポートリストを順番に使う"""
+
+    def __init__(self, backends, weights=None):
+        self.backends = backends
+        self._counter = itertools.count()
+
+    def select(self):
+        count = len(self.backends)
+        start = next(self._counter) % count
+        for i in range(count):
+            backend = self.backends[(start + i) % count]
+            if backend.available():
+                return backend
+        return None
+
+class LeastOutstandingBalancer(RoundRobinBalancer):
+    """処理中リクエストが最も少ないバックエンドを使う（同数なら順番に）"""
+
+    def select(self):
+        count = len(self.backends)
+        start = next(self._counter) % count
+        best = None
+        for i in range(count):
+            backend = self.backends[(start + i) % count]
+            if not backend.available():
+                continue
+            if best is None or backend.outstanding < best.outstanding:
+                best = backend
+        return best
+
+class WeightedBalancer:
+    """重み付きラウンドロビン（nginx の smooth weighted round-robin と同じ配分）"""
+
+    def __init__(self, backends, weights=None):
+        self.backends = backends
+        self.weights = [max(int(w), 0) for w in (weights or [])][:len(backends)]
+        self.weights += [1] * (len(backends) - len(self.weights))
+        self._current = [0] * len(backends)
+        self._lock = threading.Lock()
+
+    def select(self):
+        with self._lock:
+            best = None
+            total = 0
+            for i, weight in enumerate(self.weights):
+                if weight == 0 or not self.backends[i].available():
+                    continue
+                total += weight
+                self._current[i] += weight
+                if best is None or self._current[i] > self._current[best]:
+                    best = i
+            if best is None:
+                return None
+            self._current[best] -= total
+        return self.backends[best]
+
+BALANCERS = {
+    'round_robin': RoundRobinBalancer,
+    'least_conn': LeastOutstandingBalancer,
+    'weighted': WeightedBalancer,
+}
+
+def create_balancer(policy, backends, weights=None):
+    """ルールの balance 指定から負荷分散器を生成する"""
+    balancer_class = BALANCERS.get(policy)
+    if balancer_class is None:
+        logger.warning(f"Unknown balance policy '{policy}', using round_robin")
+        balancer_class = RoundRobinBalancer
+    return balancer_class(backends, weights)
+
+def client_ip(header, peer):
+    """クライアントの IP（X-Real-IP、X-Forwarded-For の最後の値、接続元の順）
+
+    ヘッダーはループバックから来た（同じホストの nginx が付けた）場合だけ信用する。
+    """
+    if not (peer.startswith('127.') or peer == '::1'):
+        return peer
+    real_ip = (header('X-Real-IP') or '').strip()
+    if real_ip:
+        return real_ip
+    forwarded = (header('X-Forwarded-For') or '').split(',')[-1].strip()
+    return forwarded or peer
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    """コンシステントハッシュのリング
+
+    各バックエンドを (ip:port#番号) のハッシュで replicas×重み 個の点として置くので、
+    ポートリストが変わっても移動するキーは増減したバックエンドの分だけで済む。
+    検索は bisect による O(log n)。
+    """
+
+    def __init__(self, backends, weights=None, replicas=DEFAULT_AFFINITY_REPLICAS):
+        weights = [max(int(w), 0) for w in (weights or [])][:len(backends)]
+        weights += [1] * (len(backends) - len(weights))
+        points = []
+        for backend, weight in zip(backends, weights):
+            for i in range(replicas * weight):
+                points.append((ring_hash(f"{backend.ip}:{backend.port}#{i}"), backend))
+        points.sort(key=lambda point: point[0])
+        self.hashes = [h for h, _ in points]
+        self.owners = [backend for _, backend in points]
+        self.count = len(set(backends))
+
+    def select(self, key):
+        """キーを担当するバックエンド（利用できなければリング上の次の点）を返す"""
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, ring_hash(key))
+        seen = set()
+        for i in range(len(self.hashes)):
+            backend = self.owners[(index + i) % len(self.hashes)]
+            if backend in seen:
+                continue
+            if backend.available():
+                return backend
+            seen.add(backend)
+            if len(seen) == self.count:
+                break
+        return None
+
+def parse_ip(value):
+    """IP アドレス文字列を (4 または 6, 整数) にする（IPv4 射影アドレスは IPv4 扱い）。不正なら None"""
+    try:
+        if ':' in value:
+            packed = socket.inet_pton(socket.AF_INET6, value.split('%', 1)[0])
+            if packed[:12] == b'\0' * 10 + b'\xff\xff':
+                return 4, int.from_bytes(packed[12:], 'big')
+            return 6, int.from_bytes(packed, 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, value), 'big')
+    except (OSError, ValueError):
+        return None
+
+class AddressMatcher:
+    """ルールの ips 許可リストをファミリーごとの整列済み整数範囲にコンパイルしたもの
+
+    範囲は重なりと隣接をまとめてあり、検索は bisect による O(log n)。
+    リクエストごとに ipaddress のオブジェクトは作らない。
+    """
+    __slots__ = ('ranges',)
+
+    def __init__(self, networks):
+        spans = {4: [], 6: []}
+        for network in networks:
+            first = int(network.network_address)
+            spans[network.version].append((first, first + network.num_addresses - 1))
+        self.ranges = {}
+        for version, items in spans.items():
+            merged = []
+            for first, last in sorted(items):
+                if merged and first <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], last)
+                else:
+                    merged.append([first, last])
+            self.ranges[version] = ([first for first, _ in merged], [last for _, last in merged])
+
+    @classmethod
+    def from_rule(cls, rule):
+        """ips がないか "any" を含む場合は None（制限なし）"""
+        ips = rule.get('ips')
+        if ips is None:
+            return None
+        if isinstance(ips, str):
+            ips = [ips]
+        networks = []
+        for entry in ips:
+            if str(entry).strip().lower() in ('any', '*', 'all'):
+                return None
+            try:
+                networks.append(ipaddress.ip_network(str(entry).strip(), strict=False))
+            except ValueError:
+                logger.warning(f"Ignoring invalid ips entry: {entry}")
+        if not networks:
+            logger.warning(f"No valid ips entry ({list(ips)}), denying all clients")
+        return cls(networks)
+
+    def allows(self, ip):
+        parsed = parse_ip(ip)
+        if parsed is None:
+            return False
+        version, value = parsed
+        starts, ends = self.ranges[version]
+        i = bisect.bisect_right(starts, value) - 1
+        return i >= 0 and value <= ends[i]
+
+class RateSpec:
+    """トークンバケットの設定（rate は毎秒の補充数、burst はバケットの容量）"""
+    __slots__ = ('rate', 'burst')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    @classmethod
+    def from_spec(cls, spec):
+        if not isinstance(spec, Mapping) or float(spec.get('rate', 0)) <= 0:
+            return None
+        rate = float(spec['rate'])
+        return cls(rate, float(spec.get('burst', max(rate, 1))))
+
+class RateLimiter:
+    """キーごとのトークンバケットの表
+
+    キー数は max_entries を上限とし、超えたら最も長く使われていないものから捨てる。
+    捨てられたキーは次に来たときに満杯のバケットから始まる。
+    """
+
+    def __init__(self, max_entries=DEFAULT_RATE_LIMIT_TABLE_SIZE):
+        self.max_entries = max_entries
+        self.evicted = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, spec):
+        """トークンを1つ使う。使えれば 0、足りなければ次のトークンまでの秒数を返す"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [spec.burst, now]
+                if len(self._buckets) > self.max_entries:
+                    self._buckets.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(spec.burst, bucket[0] + (now - bucket[1]) * spec.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / spec.rate
+
+    def check(self, scope, key, spec):
+        """レート制限に掛かった場合は補充までの秒数を返し、メトリクスに数える"""
+        if spec is None:
+            return 0
+        wait = self.take(key, spec)
+        if wait:
+            metrics.inc('lpg_rate_limited_total', (('scope', scope),))
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._buckets), 'max_entries': self.max_entries,
+                    'evicted': self.evicted}
+
+rate_limiter = RateLimiter()
+
+class AffinitySpec:
+    """ルールの affinity 設定（ip / cookie / sid）"""
+    __slots__ = ('by', 'cookie', 'ring')
+
+    def __init__(self, spec, backends, weights):
+        self.by = spec.get('by', 'ip')
+        self.cookie = spec.get('cookie', DEFAULT_AFFINITY_COOKIE)
+        self.ring = HashRing(backends, weights, int(spec.get('replicas', DEFAULT_AFFINITY_REPLICAS)))
+
+    @classmethod
+    def from_rule(cls, rule, backends):
+        spec = rule.get('affinity')
+        if isinstance(spec, str):
+            spec = {'by': spec}
+        if not isinstance(spec, Mapping):
+            return None
+        if spec.get('by', 'ip') not in ('ip', 'cookie', 'sid'):
+            logger.warning(f"Unknown affinity '{spec.get('by')}', using ip")
+            spec = {**spec, 'by': 'ip'}
+        return cls(spec, backends, rule.get('weights'))
+
+    def key(self, path, header, peer):
+        """リクエストのアフィニティキー（cookie や sid がなければクライアント IP）"""
+        if self.by == 'cookie':
+            try:
+                morsel = SimpleCookie(header('Cookie') or '').get(self.cookie)
+            except CookieError:
+                morsel = None
+            if morsel is not None and morsel.value:
+                return 'cookie:' + morsel.value
+        elif self.by == 'sid':
+            sid = socketio_sid(path)
+            if sid:
+                return 'sid:' + sid
+        return 'ip:' + client_ip(header, peer)
+
+def socketio_sid(path):
+    """socket.io / engine.io のクエリから sid を取り出す"""
+    _, _, query = path.partition('?')
+    values = parse_qs(query).get('sid') if 'sid=' in query else None
+    return values[0] if values else None
+
+class AffinityPins:
+    """socket.io のハンドシェイクで払い出された sid と担当バックエンドの対応
+
+    sid はハンドシェイクの応答で初めて分かるため、ハンドシェイクを処理した
+    バックエンドを記録しておき、リングより優先して使う。
+    """
+
+    def __init__(self, max_size=MAX_AFFINITY_PINS):
+        self.max_size = max_size
+        self._pins = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, route, sid):
+        with self._lock:
+            key = (route.host, route.prefix, sid)
+            backend = self._pins.get(key)
+            if backend is not None:
+                self._pins.move_to_end(key)
+            return backend
+
+    def put(self, route, sid, backend):
+        with self._lock:
+            self._pins[(route.host, route.prefix, sid)] = backend
+            self._pins.move_to_end((route.host, route.prefix, sid))
+            while len(self._pins) > self.max_size:
+                self._pins.popitem(last=False)
+
+affinity_pins = AffinityPins()
+
+class SidRecorder:
+    """ハンドシェイク応答の先頭から sid を拾って AffinityPins に記録する"""
+    LIMIT = 1024
+
+    def __init__(self, route, backend):
+        self.route = route
+        self.backend = backend
+        self.head = b''
+
+    def write(self, data):
+        if len(self.head) < self.LIMIT:
+            self.head += bytes(data[:self.LIMIT - len(self.head)])
+
+    def commit(self):
+        match = SOCKETIO_SID_PATTERN.search(self.head)
+        if match:
+            affinity_pins.put(self.route, match.group(1).decode('latin-1'), self.backend)
+
+class TimeoutSpec:
+    """ルールの timeouts 設定（connect / read / total、total は 0 で無制限）
+
+    read は1回の読み込みを待つ上限、total はリクエスト全体（再試行を含む）の上限で、
+    total はバックエンドからの読み込みごとに確認する。
+    """
+    __slots__ = ('connect', 'read', 'total')
+
+    def __init__(self, spec):
+        self.connect = float(spec.get('connect', DEFAULT_CONNECT_TIMEOUT))
+        self.read = float(spec.get('read', DEFAULT_READ_TIMEOUT))
+        self.total = float(spec.get('total', DEFAULT_TOTAL_TIMEOUT))
+
+    def deadline(self):
+        return time.monotonic() + self.total if self.total > 0 else None
+
+    def remaining(self, deadline):
+        """次の読み込みに使うタイムアウト（total の残り時間で頭打ち）"""
+        if deadline is None:
+            return self.read
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Backend total timeout exceeded")
+        return min(self.read, remaining)
+
+class RetrySpec:
+    """ルールの retries 設定（冪等メソッドを別のバックエンドで再試行する）"""
+    __slots__ = ('attempts', 'statuses')
+
+    def __init__(self, spec):
+        self.attempts = int(spec.get('attempts', DEFAULT_RETRY_ATTEMPTS))
+        self.statuses = frozenset(int(s) for s in spec.get('statuses', DEFAULT_RETRY_STATUSES))
+
+class RetryBudget:
+    """再試行の全体予算
+
+    リクエストごとに ratio 分、時間経過で毎秒 min_per_second 分のトークンが貯まり、
+    再試行1回でトークンを1つ使う。障害時に再試行が負荷を増幅しないよう、
+    再試行はおおむねリクエスト数の ratio 倍までに抑えられる。
+    """
+
+    def __init__(self, ratio=DEFAULT_RETRY_BUDGET_RATIO,
+                 min_per_second=DEFAULT_RETRY_BUDGET_MIN_PER_SECOND):
+        self.configure(ratio, min_per_second)
+        self.tokens = self.capacity
+        self.retries = 0
+        self.exhausted = 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def configure(self, ratio, min_per_second):
+        self.ratio = float(ratio)
+        self.min_per_second = float(min_per_second)
+        self.capacity = max(self.min_per_second * 10, 10)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.min_per_second)
+        self._last = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """再試行してよければトークンを1つ使って True を返す"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.retries += 1
+                return True
+            self.exhausted += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {'tokens': round(self.tokens, 2), 'capacity': self.capacity,
+                    'retries': self.retries, 'exhausted': self.exhausted}
+
+retry_budget = RetryBudget()
+
+class BackendRetry(Exception):
+    """クライアントに応答する前のバックエンド障害で、別のバックエンドで再試行する"""
+
+class Route:
+    """コンパイル済みの hostingdevice ルール"""
+    __slots__ = ('host', 'prefix', 'rule', 'backend_ip', 'backend_ports', 'strip',
+                 'max_body_size', 'balancer', 'affinity', 'breaker', 'cache', 'coalesce',
+                 'compress', 'timeouts', 'retries', 'route_limit', 'client_limit', 'allow')
+
+    def __init__(self, host, prefix, rule, options):
+        self.host = host
+        self.prefix = prefix
+        self.rule = rule
+        self.backend_ip = rule.get('deviceip')
+        self.backend_ports = tuple(rule.get('port', ()))
+        self.max_body_size = int(rule.get('max_body_size',
+                                          options.get('max_body_size', DEFAULT_MAX_BODY_SIZE)))
+        endpoints = [backends.get(self.backend_ip, port) for port in self.backend_ports]
+        self.balancer = create_balancer(rule.get('balance', 'round_robin'), endpoints,
+                                        rule.get('weights'))
+        self.affinity = AffinitySpec.from_rule(rule, endpoints)
+        self.breaker = CircuitBreakerSpec({**options.get('circuit_breaker', {}),
+                                           **rule.get('circuit_breaker', {})})
+        self.cache = RouteCacheSpec.from_rule(rule)
+        self.coalesce = bool(rule.get('coalesce', False))
+        self.compress = CompressSpec.from_rule(rule)
+        self.timeouts = TimeoutSpec({**options.get('timeouts', {}), **rule.get('timeouts', {})})
+        self.retries = RetrySpec({**options.get('retries', {}), **rule.get('retries', {})})
+        self.allow = AddressMatcher.from_rule(rule)
+        rate_limit = rule.get('rate_limit', {})
+        self.route_limit = RateSpec.from_spec(rate_limit.get('route'))
+        self.client_limit = RateSpec.from_spec(rate_limit.get('client'))
+        # パスの書き換え：プレフィックスを削除（ルート "/" の場合はそのまま）
+        self.strip = prefix.strip('/') != ''
+
+    def alternate_backend(self, tried):
+        """再試行先（未試行で利用可能なもののうち処理中が最も少ないもの）を返す
+
+        エンドポイントが1つだけのルールでは同じバックエンドに再試行する。
+        """
+        candidates = [b for b in self.balancer.backends if b not in tried and b.available()]
+        if not candidates and len(set(self.balancer.backends)) == 1 and tried[0].available():
+            candidates = tried[:1]
+        return min(candidates, key=lambda b: b.outstanding, default=None)
+
+    def select_backend(self, affinity_key=None):
+        """負荷分散ポリシー（アフィニティがあればハッシュリング）で転送先の Backend を返す"""
+        if self.affinity is not None and affinity_key is not None:
+            return self.affinity.ring.select(affinity_key)
+        return self.balancer.select()
+
+class RouteNode:
+    """パスセグメント単位のプレフィックストライのノード"""
+    __slots__ = ('children', 'route')
+
+    def __init__(self):
+        self.children = {}
+        self.route = None
+
+class RouteTable:
+    """ホストごとのプレフィックストライで最長一致のルートを検索する
+
+    設定スナップショットごとに一度だけ構築され、検索はパスの深さに比例する。
+    マッチはセグメント境界で行うため /lacisstack/boardsX は
+    /lacisstack/boards にマッチしない。
+    """
+
+    def __init__(self, config):
+        self.domains = frozenset(config.get('hostdomains', {}))
+        self.hosts = {}
+        self.routes = []
+        options = config.get('options', {})
+        # ルーティング前にクライアントごとに掛ける全体のレート制限
+        self.client_limit = RateSpec.from_spec(options.get('rate_limit', {}).get('client'))
+        for host, rules in config.get('hostingdevice', {}).items():
+            root = RouteNode()
+            for prefix, rule in rules.items():
+                node = root
+                for segment in prefix.split('/'):
+                    if segment:
+                        node = node.children.setdefault(segment, RouteNode())
+                node.route = Route(host, prefix, rule, options)
+                self.routes.append(node.route)
+            self.hosts[host] = root
+
+    def lookup(self, host, path):
+        """(route, backend_path) を返す。該当なしの場合は RouteError を送出する"""
+        # ホストドメインの確認
+        if host not in self.domains:
+            raise RouteError(404, "Domain not configured")
+        
+        node = self.hosts.get(host)
+        if node is None:
+            raise RouteError(404, "Path not configured")
+        
+        path_only, sep, query = path.partition('?')
+        matched = node.route
+        matched_end = 0
+        pos = 0
+        length = len(path_only)
+        while pos < length:
+            if path_only[pos] == '/':
+                pos += 1
+                continue
+            end = path_only.find('/', pos)
+            if end < 0:
+                end = length
+            node = node.children.get(path_only[pos:end])
+            if node is None:
+                break
+            pos = end
+            if node.route is not None:
+                matched = node.route
+                matched_end = end
+        
+        if matched is None:
+            raise RouteError(404, "Path not configured")
+        
+        # /lacisstack/boards/xxx -> /xxx
+        # /lacisstack/boards -> /
+        # /lacisstack/boards/ -> /
+        if matched.strip:
+            backend_path = (path_only[matched_end:] or '/') + sep + query
+        else:
+            backend_path = path
+        return matched, backend_path
+
+class ConfigSnapshot:
+    """ある時点の config.json の不変スナップショットとコンパイル済みルート"""
+    __slots__ = ('data', 'stamp', 'routes')
+
+    def __init__(self, data, stamp):
+        self.data = freeze(data)
+        self.stamp = stamp
+        self.routes = RouteTable(self.data)
+
+class ConfigStore:
+    """config.json をメモリ上にキャッシュし、変更時のみ再読み込みする
+
+    ファイルの (inode, mtime, size) を CONFIG_CHECK_INTERVAL 秒に1回だけ確認し、
+    変化があれば読み込んだ新しいスナップショットを丸ごと差し替える。
+    処理中のリクエストは取得済みのスナップショットを使い続けるため一貫性が保たれる。
+    パースに失敗した場合は最後に正常に読み込めたスナップショットを維持する。
+    """
+
+    def __init__(self, path, check_interval=CONFIG_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot = ConfigSnapshot({}, None)
+        self._stamp = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """スナップショット差し替え時に listener(snapshot) を呼び出す"""
+        self._listeners.append(listener)
+
+    def get(self):
+        """現在のスナップショットを返す（必要なら再読み込みする）"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            # 初回読み込み前は完了を待つ。以降は他スレッドが確認中なら現行スナップショットを使う
+            if self._lock.acquire(blocking=self._snapshot.stamp is None):
+                try:
+                    if now >= self._next_check:
+                        self._check()
+                        self._next_check = time.monotonic() + self.check_interval
+                finally:
+                    self._lock.release()
+        return self._snapshot
+
+    def _check(self):
         try:
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
+            st = os.stat(self.path)
+        except OSError as e:
+            if self._stamp != 'missing':
+                logger.error(f"Failed to load config: {e}")
+                self._stamp = 'missing'
+            return
+        
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return
+        self._stamp = stamp
+        
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = ConfigSnapshot(json.load(f), stamp)
+        except Exception as e:
+            logger.error(f"Failed to load config, keeping last good snapshot: {e}")
+            return
+        
+        self._snapshot = snapshot
+        logger.info(f"Config loaded from {self.path}")
+        for listener in self._listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logger.error(f"Config listener error: {e}")
+
+config_store = ConfigStore(CONFIG_FILE)
+
+def load_config():
+    """現在の設定スナップショットを返す"""
+    return config_store.get()
+
+def load_options():
+    """config.json の options セクションを読み込む"""
+    return load_config().data.get('options', {})
+
+def check_rate_limits(snapshot, route, ip):
+    """レート制限に掛かった場合は補充までの秒数を返す（route が None ならルーティング前の全体分）"""
+    if route is None:
+        return rate_limiter.check('client', ip, snapshot.routes.client_limit)
+    return (rate_limiter.check('route', (route.host, route.prefix), route.route_limit)
+            or rate_limiter.check('route_client', (route.host, route.prefix, ip), route.client_limit))
+
+def resolve_route(snapshot, host, path):
+    """ホストとパスから (route, backend_path) を決定する"""
+    route, backend_path = snapshot.routes.lookup(host, path)
+    
+    # バックエンドのIPとポートを確認
+    if not route.backend_ip or not route.backend_ports:
+        raise RouteError(502, "Backend not configured")
+    return route, backend_path
+
+def select_backend(route, path='', header=None, peer=''):
+    """ルートの負荷分散ポリシーで転送先の Backend を選ぶ
+
+    アフィニティが設定されたルートでは path・header（名前から値を返す関数）・
+    接続元 peer からキーを作る。socket.io の sid はハンドシェイクで記録した
+    バックエンドを優先する。
+    """
+    affinity_key = None
+    if route.affinity is not None and header is not None:
+        if route.affinity.by == 'sid':
+            sid = socketio_sid(path)
+            pinned = affinity_pins.get(route, sid) if sid else None
+            if pinned is not None and pinned.available():
+                return pinned
+        affinity_key = route.affinity.key(path, header, peer)
+    backend = route.select_backend(affinity_key)
+    if backend is None:
+        raise RouteError(503, "No available backend")
+    return backend
+
+class HealthCheckSpec:
+    """ルールの health_check 設定"""
+    __slots__ = ('type', 'path', 'host', 'interval', 'timeout', 'rise', 'fall', 'jitter',
+                 'expect_status')
+
+    def __init__(self, spec):
+        self.type = spec.get('type', 'http')
+        self.path = spec.get('path', '/')
+        self.host = spec.get('host')
+        self.interval = float(spec.get('interval', DEFAULT_HEALTH_INTERVAL))
+        self.timeout = float(spec.get('timeout', DEFAULT_HEALTH_TIMEOUT))
+        self.rise = int(spec.get('rise', DEFAULT_HEALTH_RISE))
+        self.fall = int(spec.get('fall', DEFAULT_HEALTH_FALL))
+        self.jitter = float(spec.get('jitter', DEFAULT_HEALTH_JITTER))
+        self.expect_status = tuple(spec.get('expect_status', (200, 399)))
+
+    def key(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+class HealthChecker:
+    """1つのバックエンドを定期的にプローブするスレッド"""
+
+    def __init__(self, backend, spec):
+        self.backend = backend
+        self.spec = spec
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"lpg-health-{backend}", daemon=True)
+
+    def start(self):
+        self.backend.checked = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # 起動直後のプローブが同時に集中しないようにずらす
+        if self._stop.wait(random.uniform(0, self.spec.jitter)):
+            return
+        while not self._stop.is_set():
+            ok, error = self.probe()
+            if self._stop.is_set():
+                return
+            self.backend.record_probe(ok, error, self.spec.rise, self.spec.fall)
+            if self._stop.wait(self.spec.interval + random.uniform(0, self.spec.jitter)):
+                return
+
+    def probe(self):
+        """(成功したか, エラー内容) を返す"""
+        spec = self.spec
+        try:
+            if spec.type == 'tcp':
+                socket.create_connection((self.backend.ip, self.backend.port), spec.timeout).close()
+                return True, None
+            
+            conn = http.client.HTTPConnection(self.backend.ip, self.backend.port, timeout=spec.timeout)
+            try:
+                conn.request('GET', spec.path, headers={
+                    'Host': spec.host or str(self.backend),
+                    'User-Agent': 'lpg-health-check',
+                    'Connection': 'close',
+                })
+                response = conn.getresponse()
+                response.read()
+            finally:
+                conn.close()
+            low, high = spec.expect_status
+            if low <= response.status <= high:
+                return True, None
+            return False, f"HTTP {response.status}"
+        except (OSError, http.client.HTTPException) as e:
+            return False, str(e) or e.__class__.__name__
+
+class HealthMonitor:
+    """設定スナップショットに合わせて HealthChecker を起動・停止する"""
+
+    def __init__(self):
+        self._checkers = {}
+        self._lock = threading.Lock()
+
+    def sync(self, snapshot):
+        desired = {}
+        for route in snapshot.routes.routes:
+            spec = route.rule.get('health_check')
+            if not spec:
+                continue
+            for backend in route.balancer.backends:
+                desired.setdefault(backend, HealthCheckSpec(spec))
+        
+        with self._lock:
+            for backend, checker in list(self._checkers.items()):
+                spec = desired.get(backend)
+                if spec is None or spec.key() != checker.spec.key():
+                    checker.stop()
+                    del self._checkers[backend]
+                    if spec is None:
+                        backend.reset_health()
+            for backend, spec in desired.items():
+                if backend not in self._checkers:
+                    checker = HealthChecker(backend, spec)
+                    self._checkers[backend] = checker
+                    checker.start()
+
+health_monitor = HealthMonitor()
+
+class RouteCacheSpec:
+    """ルールの cache 設定（GET/HEAD のレスポンスキャッシュ）"""
+    __slots__ = ('max_entry_size', 'max_disk_entry_size', 'default_ttl',
+                 'stale_while_revalidate', 'stale_if_error')
+
+    def __init__(self, spec):
+        self.max_entry_size = int(spec.get('max_entry_size', DEFAULT_CACHE_MAX_ENTRY_SIZE))
+        self.max_disk_entry_size = int(spec.get('max_disk_entry_size', DEFAULT_CACHE_MAX_DISK_ENTRY_SIZE))
+        self.default_ttl = float(spec.get('default_ttl', 0))
+        # 期限切れ後も応答に使える秒数（レスポンスの同名ディレクティブが優先）
+        self.stale_while_revalidate = float(spec.get('stale_while_revalidate', 0))
+        self.stale_if_error = float(spec.get('stale_if_error', 0))
+
+    def capture_limit(self):
+        """保存できるボディの最大サイズ（ディスク層が無効ならメモリの上限）"""
+        if disk_cache.enabled:
+            return max(self.max_entry_size, self.max_disk_entry_size)
+        return self.max_entry_size
+
+    @classmethod
+    def from_rule(cls, rule):
+        spec = rule.get('cache')
+        if spec is True:
+            return cls({})
+        if isinstance(spec, Mapping) and spec.get('enabled', True):
+            return cls(spec)
+        return None
+
+def parse_cache_control(value):
+    """Cache-Control を {ディレクティブ: 値} に分解する"""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip().strip('"')
+    return directives
+
+def request_cache_mode(headers):
+    """リクエストのキャッシュ利用方法 ('lookup' / 'refresh' / 'bypass') を返す"""
+    if headers.get('Authorization') or headers.get('Range'):
+        return 'bypass'
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in directives:
+        return 'bypass'
+    if ('no-cache' in directives or directives.get('max-age') == '0'
+            or 'no-cache' in headers.get('Pragma', '').lower()):
+        return 'refresh'
+    return 'lookup'
+
+def cache_lifetime(spec, status, headers):
+    """レスポンスを保存してよい場合は有効期間（秒）を、できない場合は None を返す
+
+    spec が None の場合は default_ttl を使わず、明示された有効期間だけを認める。
+    """
+    if status not in CACHEABLE_STATUSES or headers.get('Set-Cookie'):
+        return None
+    if headers.get('Vary', '').strip() == '*':
+        return None
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in directives or 'private' in directives or 'no-cache' in directives:
+        return None
+    
+    lifetime = None
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                lifetime = int(directives[name])
+            except ValueError:
+                lifetime = 0
+            break
+    if lifetime is None and headers.get('Expires'):
+        try:
+            expires = parsedate_to_datetime(headers['Expires']).timestamp()
+            date = parsedate_to_datetime(headers['Date']).timestamp() if headers.get('Date') else time.time()
+            lifetime = expires - date
+        except (TypeError, ValueError, IndexError):
+            lifetime = 0
+    if lifetime is None:
+        lifetime = spec.default_ttl if spec is not None else 0
+    
+    try:
+        lifetime -= int(headers.get('Age', 0))
+    except ValueError:
+        pass
+    return lifetime if lifetime > 0 else None
+
+def normalize_percent_encoding(match):
+    """%xx の16進を大文字にし、非予約文字ならデコードする（RFC 3986 6.2.2）"""
+    char = chr(int(match.group(1), 16))
+    if char in UNRESERVED_CHARACTERS:
+        return char
+    return match.group(0).upper()
+
+def cache_key(route, backend_path):
+    """書き換え後のパスからキャッシュの主キーを作る
+
+    正規化は意味の変わらないパーセントエンコーディングの表記揺れだけに留める。
+    クエリの順序や連続するスラッシュはバックエンドによって意味を持つのでそのまま使う。
+    """
+    return (route.host, route.prefix, PERCENT_ENCODED_PATTERN.sub(normalize_percent_encoding,
+                                                                   backend_path))
+
+def vary_values(names, headers):
+    """Vary に挙げられたリクエストヘッダーの値を正規化して並べる"""
+    values = []
+    for name in names:
+        value = ','.join(headers.get_all(name) or ())
+        values.append(' '.join(value.lower().split()))
+    return tuple(values)
+
+def vary_names(headers):
+    """レスポンスの Vary ヘッダーを正規化したヘッダー名の並びにする"""
+    vary = ','.join(v for k, v in headers if k.lower() == 'vary')
+    return tuple(sorted({name.strip().lower() for name in vary.split(',') if name.strip()}))
+
+class CacheEntry:
+    """保存済みレスポンス（ディスク層のエントリは body を持たず filename を持つ）"""
+    __slots__ = ('status', 'headers', 'body', 'filename', 'length',
+                 'stored_at', 'expires_at', 'etag', 'size')
+
+    def __init__(self, status, headers, body, lifetime, filename=None, length=None, stored_at=None):
+        self.status = status
+        self.headers = tuple((k, v) for k, v in headers if k.lower() not in ('age', 'x-cache'))
+        self.body = body
+        self.filename = filename
+        self.length = len(body) if body is not None else length
+        self.stored_at = time.time() if stored_at is None else stored_at
+        self.expires_at = self.stored_at + lifetime
+        self.etag = next((v for k, v in headers if k.lower() == 'etag'), None)
+        self.size = self.length + sum(len(k) + len(v) for k, v in self.headers) + CACHE_ENTRY_OVERHEAD
+
+    def is_fresh(self):
+        return time.time() < self.expires_at
+
+    def age(self):
+        return int(time.time() - self.stored_at)
+
+    def staleness(self):
+        """期限切れからの経過秒数"""
+        return time.time() - self.expires_at
+
+    def header(self, name):
+        name = name.lower()
+        return next((v for k, v in self.headers if k.lower() == name), None)
+
+    def stale_windows(self, spec):
+        """(stale-while-revalidate, stale-if-error) の秒数を返す"""
+        directives = parse_cache_control(self.header('Cache-Control'))
+        if 'must-revalidate' in directives or 'proxy-revalidate' in directives:
+            return 0, 0
+        windows = []
+        for name, default in (('stale-while-revalidate', spec.stale_while_revalidate),
+                              ('stale-if-error', spec.stale_if_error)):
+            try:
+                windows.append(float(directives.get(name, default)))
+            except ValueError:
+                windows.append(default)
+        return tuple(windows)
+
+class ResponseCache:
+    """メモリ上限付きの LRU レスポンスキャッシュ
+
+    主キー（ホスト・ルート・正規化した書き換え後パス）ごとに Vary の対象ヘッダーを
+    記録し、その値を含めたキーでエントリを保持する。
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_MEMORY_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._vary = {}
+        self._variants = {}
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'stale': 0, 'misses': 0, 'bypasses': 0, 'stores': 0,
+                         'evictions': 0, 'revalidations': 0, 'revalidations_dropped': 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def lookup(self, primary, headers):
+        """エントリを返す（期限切れのものも返すので鮮度は呼び出し側で確認する）"""
+        with self._lock:
+            names = self._vary.get(primary)
+            if names is None:
+                return None
+            key = (primary, vary_values(names, headers))
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry.is_fresh():
+                    self.counters['hits'] += 1
+            return entry
+
+    def store(self, primary, request_headers, status, headers, body, lifetime):
+        entry = CacheEntry(status, headers, body, lifetime)
+        if entry.size > self.max_size:
+            return
+        names = vary_names(headers)
+        with self._lock:
+            if self._vary.get(primary, names) != names:
+                # Vary の対象が変わったら古いバリアントは使えない
+                for key in [k for k in self._entries if k[0] == primary]:
+                    self._remove(key)
+            key = (primary, vary_values(names, request_headers))
+            if key in self._entries:
+                self._remove(key)
+            self._vary[primary] = names
+            self._entries[key] = entry
+            self._variants[primary] = self._variants.get(primary, 0) + 1
+            self.size += entry.size
+            self.counters['stores'] += 1
+            while self.size > self.max_size and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.counters['evictions'] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        primary = key[0]
+        self._variants[primary] -= 1
+        if self._variants[primary] == 0:
+            del self._variants[primary]
+            self._vary.pop(primary, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._vary.clear()
+            self._variants.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), size=self.size,
+                        max_size=self.max_size)
+
+response_cache = ResponseCache()
+
+class DiskCache:
+    """ディスク上のレスポンスキャッシュ（メモリに載せない大きなボディ用の第2層）
+
+    ボディは <directory>/<ハッシュ>.body に置き、メタデータは index.json に
+    まとめて保存する。起動時に index を読み直すので再起動後も利用でき、
+    容量は max_size を上限に LRU で追い出す。
+    index の書き出しはリクエストスレッドでは行わず、変更をまとめて
+    DISK_CACHE_INDEX_DELAY 秒ごとに専用スレッドがロックの外で書き出す。
+    """
+    INDEX_FILE = 'index.json'
+
+    def __init__(self):
+        self.directory = None
+        self.max_size = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._vary = {}
+        self._variants = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._changed = threading.Event()
+        self._writer = None
+        self._write_lock = threading.Lock()
+        self.counters = {'hits': 0, 'stores': 0, 'evictions': 0, 'errors': 0}
+
+    @property
+    def enabled(self):
+        return self.directory is not None and self.max_size > 0
+
+    def open(self, directory, max_size):
+        """キャッシュディレクトリを準備して index を読み込む"""
+        if max_size <= 0:
+            return
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Disk cache disabled: {directory}: {e}")
+            return
+        with self._lock:
+            self.directory = directory
+            self.max_size = max_size
+            self._load()
+            while self.size > self.max_size and self._entries:
+                self._remove(next(iter(self._entries)))
+            self._dirty = True
+        self.flush()
+        logger.info(f"Disk cache {directory}: {len(self._entries)} entries, {self.size} bytes")
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE)) as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            records = []
+        except (OSError, ValueError) as e:
+            logger.warning(f"Disk cache index unreadable, starting empty: {e}")
+            records = []
+        
+        for record in records:
+            try:
+                primary, values = tuple(record['key'][0]), tuple(record['key'][1])
+                path = os.path.join(self.directory, record['file'])
+                if os.path.getsize(path) != record['length']:
+                    continue
+                entry = CacheEntry(record['status'], [tuple(h) for h in record['headers']], None,
+                                   record['expires_at'] - record['stored_at'],
+                                   filename=record['file'], length=record['length'],
+                                   stored_at=record['stored_at'])
+            except (OSError, KeyError, TypeError, ValueError, IndexError):
+                continue
+            self._vary[primary] = tuple(record.get('vary', ()))
+            self._add((primary, values), entry)
+        
+        # index にないファイル（書き込み途中で止まったものなど）は削除する
+        known = {entry.filename for entry in self._entries.values()}
+        for name in os.listdir(self.directory):
+            if name.endswith(('.body', '.tmp')) and name not in known:
+                self._unlink(name)
+
+    def _save(self):
+        """index の書き出しを書き込みスレッドに依頼する（self._lock を保持して呼ぶ）"""
+        self._dirty = True
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name='lpg-disk-cache', daemon=True)
+            self._writer.start()
+        self._changed.set()
+
+    def _run(self):
+        while True:
+            self._changed.wait()
+            time.sleep(DISK_CACHE_INDEX_DELAY)
+            self._changed.clear()
+            self.flush()
+
+    def flush(self):
+        """変更があれば index.json を書き出す（release() 後は何もしない）"""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty or not self.enabled:
+                    return
+                self._dirty = False
+                entries = list(self._entries.items())
+                vary = dict(self._vary)
+            records = []
+            for (primary, values), entry in entries:
+                records.append({
+                    'key': [primary, values], 'vary': vary.get(primary, ()),
+                    'status': entry.status, 'headers': entry.headers, 'file': entry.filename,
+                    'length': entry.length, 'stored_at': entry.stored_at,
+                    'expires_at': entry.expires_at,
+                })
+            path = os.path.join(self.directory, self.INDEX_FILE)
+            try:
+                with open(path + '.new', 'w') as f:
+                    json.dump(records, f, separators=(',', ':'))
+                os.replace(path + '.new', path)
+            except OSError as e:
+                self.counters['errors'] += 1
+                logger.warning(f"Disk cache index write failed: {e}")
+
+    def create_temp(self):
+        """ボディを書き込む一時ファイルを作る（失敗時は None）"""
+        try:
+            return tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+        except OSError as e:
+            self.counters['errors'] += 1
+            logger.warning(f"Disk cache temp file failed: {e}")
+            return None
+
+    def discard_temp(self, temp):
+        temp.close()
+        self._unlink(os.path.basename(temp.name))
+
+    def lookup(self, primary, headers):
+        """エントリを返す（期限切れのものも返すので鮮度は呼び出し側で確認する）"""
+        with self._lock:
+            names = self._vary.get(primary)
+            if names is None:
+                return None
+            key = (primary, vary_values(names, headers))
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry.is_fresh():
+                    self.counters['hits'] += 1
+            return entry
+
+    def open_body(self, entry):
+        """エントリのボディファイルを開く（消えていた場合は None）"""
+        try:
+            return open(os.path.join(self.directory, entry.filename), 'rb')
+        except OSError:
+            with self._lock:
+                for key in [k for k, e in self._entries.items() if e is entry]:
+                    self._remove(key)
+            return None
+
+    def release(self):
+        """リロード時に後継プロセスへディレクトリを明け渡す（以降は保存も index の更新もしない）"""
+        with self._write_lock, self._lock:
+            self.max_size = 0
+
+    def refresh(self, primary, request_headers, entry, headers, lifetime):
+        """再検証 (304) の結果でエントリのヘッダーと有効期限を更新する"""
+        key = (primary, vary_values(self._vary.get(primary, ()), request_headers))
+        with self._lock:
+            if self._entries.get(key) is not entry or not self.enabled:
+                return
+            names = self._vary[primary]
+            self._remove(key, unlink=False)
+            self._vary[primary] = names
+            self._add(key, CacheEntry(entry.status, headers, None, lifetime,
+                                      filename=entry.filename, length=entry.length))
+            self._save()
+
+    def store(self, primary, request_headers, status, headers, temp, lifetime):
+        """書き込み済みの一時ファイルをキャッシュエントリとして登録する"""
+        try:
+            temp.close()
+            length = os.path.getsize(temp.name)
+        except OSError:
+            self._unlink(os.path.basename(temp.name))
+            return
+        names = vary_names(headers)
+        key = (primary, vary_values(names, request_headers))
+        filename = hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.body'
+        entry = CacheEntry(status, headers, None, lifetime, filename=filename, length=length)
+        if entry.size > self.max_size:
+            self._unlink(os.path.basename(temp.name))
+            return
+        
+        with self._lock:
+            if self._vary.get(primary, names) != names:
+                for old in [k for k in self._entries if k[0] == primary]:
+                    self._remove(old)
+            if key in self._entries:
+                self._remove(key, unlink=False)
+            try:
+                os.replace(temp.name, os.path.join(self.directory, filename))
+            except OSError as e:
+                self.counters['errors'] += 1
+                logger.warning(f"Disk cache store failed: {e}")
+                self._unlink(os.path.basename(temp.name))
+                return
+            self._vary[primary] = names
+            self._add(key, entry)
+            self.counters['stores'] += 1
+            while self.size > self.max_size and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.counters['evictions'] += 1
+            self._save()
+
+    def _add(self, key, entry):
+        self._entries[key] = entry
+        self._variants[key[0]] = self._variants.get(key[0], 0) + 1
+        self.size += entry.size
+
+    def _remove(self, key, unlink=True):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        primary = key[0]
+        self._variants[primary] -= 1
+        if self._variants[primary] == 0:
+            del self._variants[primary]
+            self._vary.pop(primary, None)
+        if unlink:
+            self._unlink(entry.filename)
+
+    def _unlink(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def clear(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+            self._save()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, enabled=self.enabled, directory=self.directory,
+                        entries=len(self._entries), size=self.size, max_size=self.max_size)
+
+disk_cache = DiskCache()
+
+class CacheWriter:
+    """中継中のボディを受け取り、大きさに応じてメモリかディスクに保存する"""
+
+    def __init__(self, spec, limit):
+        self.spec = spec
+        self.limit = limit
+        self.buffer = bytearray()
+        self.temp = None
+        self.length = 0
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        self.length += len(data)
+        if self.length > self.limit:
+            self.abort()
+            return
+        if self.temp is None:
+            if self.length <= self.spec.max_entry_size:
+                self.buffer += data
+                return
+            # メモリ層の上限を超えたらディスクの一時ファイルに切り替える
+            self.temp = disk_cache.create_temp() if disk_cache.enabled else None
+            if self.temp is None:
+                self.abort()
+                return
+            data = self.buffer + data
+            self.buffer = None
+        try:
+            self.temp.write(data)
+        except OSError as e:
+            logger.warning(f"Disk cache write failed: {e}")
+            disk_cache.counters['errors'] += 1
+            self.abort()
+
+    def abort(self):
+        self.failed = True
+        self.buffer = None
+        if self.temp is not None:
+            disk_cache.discard_temp(self.temp)
+            self.temp = None
+
+    def commit(self, primary, request_headers, status, headers, lifetime):
+        if self.failed:
+            return
+        if self.temp is None:
+            response_cache.store(primary, request_headers, status, headers, bytes(self.buffer), lifetime)
+        else:
+            disk_cache.store(primary, request_headers, status, headers, self.temp, lifetime)
+
+def merge_revalidated_headers(entry, response):
+    """304 レスポンスのヘッダーで保存済みヘッダーを更新する"""
+    updated = {k.lower(): (k, v) for k, v in response.getheaders()
+               if k.lower() not in RESPONSE_SKIP_HEADERS}
+    headers = [updated.pop(k.lower(), (k, v)) for k, v in entry.headers]
+    return headers + list(updated.values())
+
+class Revalidator:
+    """期限切れのキャッシュエントリをバックグラウンドで条件付きリクエストにより再検証する
+
+    同じエントリの再検証は同時に1つだけ実行する。再検証は REVALIDATE_WORKERS 本の
+    ワーカーで処理し、キューが満杯のときは期限切れのコピーを返し済みなので見送る。
+    """
+
+    def __init__(self):
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def submit(self, route, primary, backend_path, entry, request_headers, forward_headers):
+        with self._lock:
+            if id(entry) in self._pending:
+                return
+            self._pending.add(id(entry))
+            if self._pool is None:
+                self._pool = BoundedWorkerPool(self._run, REVALIDATE_WORKERS, REVALIDATE_QUEUE_SIZE,
+                                               name='lpg-revalidate')
+        if not self._pool.submit(route, primary, backend_path, entry, request_headers,
+                                 forward_headers):
+            with self._lock:
+                self._pending.discard(id(entry))
+            response_cache.count('revalidations_dropped')
+            logger.debug(f"Revalidation queue full, skipping {backend_path}")
+
+    def _run(self, route, primary, backend_path, entry, request_headers, forward_headers):
+        try:
+            self.revalidate(route, primary, backend_path, entry, request_headers, forward_headers)
         except Exception as e:
-            logger.error(f"Failed to load config: {e}")
-            return {}
+            logger.warning(f"Revalidation of {backend_path} failed: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(id(entry))
+
+    def revalidate(self, route, primary, backend_path, entry, request_headers, forward_headers):
+        backend = route.select_backend()
+        permit = backend.begin(route.breaker) if backend is not None else None
+        if permit is None:
+            return
+        ok = False
+        try:
+            conn, _ = backend_pool.acquire(backend.ip, backend.port)
+            reusable = False
+            try:
+                if conn.sock is None:
+                    conn.timeout = route.timeouts.connect
+                    conn.connect()
+                conn.sock.settimeout(route.timeouts.read)
+                conn.putrequest('GET', backend_path, skip_accept_encoding=True)
+                for header, value in request_headers.items():
+                    if header.lower() not in REVALIDATE_SKIP_HEADERS:
+                        conn.putheader(header, value)
+                for header, value in forward_headers:
+                    conn.putheader(header, value)
+                if entry.etag:
+                    conn.putheader('If-None-Match', entry.etag)
+                if entry.header('Last-Modified'):
+                    conn.putheader('If-Modified-Since', entry.header('Last-Modified'))
+                conn.endheaders()
+                response = conn.getresponse()
+                ok = response.status < 500
+                
+                if response.status == 304:
+                    response.read()
+                    headers = merge_revalidated_headers(entry, response)
+                    merged = http.client.HTTPMessage()
+                    for header, value in headers:
+                        merged[header] = value
+                    lifetime = cache_lifetime(route.cache, entry.status, merged)
+                    if lifetime is not None:
+                        if entry.filename:
+                            disk_cache.refresh(primary, request_headers, entry, headers, lifetime)
+                        else:
+                            response_cache.store(primary, request_headers, entry.status,
+                                                 headers, entry.body, lifetime)
+                        response_cache.count('revalidations')
+                else:
+                    # 内容が変わっていれば通常の取得と同様に保存し直す
+                    headers = [(k, v) for k, v in response.getheaders()
+                               if k.lower() not in RESPONSE_SKIP_HEADERS]
+                    lifetime = cache_lifetime(route.cache, response.status, response.headers)
+                    writer = CacheWriter(route.cache, route.cache.capture_limit()) if lifetime else None
+                    while True:
+                        data = response.read(RELAY_BUFFER_SIZE)
+                        if not data:
+                            break
+                        if writer is not None:
+                            writer.write(data)
+                    if writer is not None:
+                        writer.commit(primary, request_headers, response.status, headers, lifetime)
+                reusable = not response.will_close
+            finally:
+                backend_pool.release(conn, reusable)
+        finally:
+            backend.end(permit, ok, route.breaker)
+
+revalidator = Revalidator()
+
+def response_shareable(spec, status, headers):
+    """他のクライアントにも同じ内容を返してよいレスポンスかどうか（キャッシュできるものに限る）"""
+    return cache_lifetime(spec, status, headers) is not None
+
+class FlightAborted(Exception):
+    """共有中のバックエンド応答が途中で失われた"""
+
+class Flight:
+    """1つのバックエンド応答を同じリクエストの待機者に配る
+
+    先頭のリクエスト（リーダー）がヘッダーとボディを流し込み、待機者は
+    それぞれの位置から読み出す。全員が読み終えたチャンクは捨てるので、
+    バッファは最も遅い待機者との差分だけになる。
+    """
+
+    def __init__(self, request_headers):
+        self.request_headers = request_headers
+        self.cond = threading.Condition()
+        self.status = None
+        self.headers = None
+        self.length = None
+        self.vary = None
+        self.shared = False
+        self.chunks = []
+        self.base = 0
+        self.buffered = 0
+        self.done = False
+        self.failed = False
+        self.readers = {}
+
+    def publish(self, status, headers, length, shared):
+        names = vary_names(headers)
+        with self.cond:
+            self.status = status
+            self.headers = headers
+            self.length = length
+            self.vary = (names, vary_values(names, self.request_headers))
+            self.shared = shared and bool(self.readers)
+            if not self.shared:
+                self.done = True
+            self.cond.notify_all()
+
+    def write(self, data):
+        if not self.shared:
+            return
+        with self.cond:
+            if not self.readers:
+                return
+            self.chunks.append(bytes(data))
+            self.buffered += len(data)
+            # 追いつけない待機者は切り離してバッファを抑える
+            while self.buffered > COALESCE_MAX_BUFFER and self.readers:
+                slowest = min(self.readers, key=self.readers.get)
+                del self.readers[slowest]
+                self._trim()
+            self.cond.notify_all()
+
+    def finish(self, failed=False):
+        with self.cond:
+            self.done = True
+            self.failed = failed or self.status is None
+            self.cond.notify_all()
+
+    def join(self):
+        """待機者として登録する（ヘッダー公開前のみ）。登録できなければ None"""
+        with self.cond:
+            if self.status is not None or self.done:
+                return None
+            token = object()
+            self.readers[token] = 0
+            return token
+
+    def leave(self, token):
+        with self.cond:
+            if self.readers.pop(token, None) is not None:
+                self._trim()
+
+    def wait_headers(self, token, timeout=COALESCE_WAIT_TIMEOUT):
+        """ヘッダーを待つ。共有できる応答なら True"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.status is None and not self.done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.status is not None and self.shared and token in self.readers
+
+    def read(self, token):
+        """次のチャンクを返す。終端なら None"""
+        with self.cond:
+            while True:
+                if token not in self.readers:
+                    raise FlightAborted("Reader fell too far behind")
+                position = self.readers[token]
+                if position < self.base + len(self.chunks):
+                    data = self.chunks[position - self.base]
+                    self.readers[token] = position + 1
+                    self._trim()
+                    return data
+                if self.done:
+                    if self.failed:
+                        raise FlightAborted("Backend response was interrupted")
+                    return None
+                self.cond.wait()
+
+    def _trim(self):
+        lowest = min(self.readers.values(), default=self.base + len(self.chunks))
+        while self.base < lowest and self.chunks:
+            self.buffered -= len(self.chunks.pop(0))
+            self.base += 1
+
+class FlightTable:
+    """キャッシュキーごとに進行中の Flight を管理する"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.counters = {'leaders': 0, 'followers': 0}
+
+    def begin(self, key, request_headers):
+        """(flight, leader) を返す。leader が False なら既存の Flight に相乗りする"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(request_headers)
+                self.counters['leaders'] += 1
+                return flight, True
+            self.counters['followers'] += 1
+            return flight, False
+
+    def end(self, key, flight, failed=False):
+        flight.finish(failed)
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._flights))
+
+flights = FlightTable()
+
+class Tunnel:
+    """クライアントとバックエンドの間の双方向トンネル"""
+    __slots__ = ('client', 'backend', 'label', 'on_close', 'pending', 'events',
+                 'bytes_up', 'bytes_down', 'started', 'last_active')
+
+    def __init__(self, client, backend, label, on_close):
+        self.client = client
+        self.backend = backend
+        self.label = label
+        self.on_close = on_close
+        # ソケットごとの未送信データと、セレクタに登録中のイベント
+        self.pending = {client: b'', backend: b''}
+        self.events = {client: 0, backend: 0}
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.started = self.last_active = time.monotonic()
+
+    def peer(self, sock):
+        return self.backend if sock is self.client else self.client
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'target': self.label,
+            'bytes_up': self.bytes_up,
+            'bytes_down': self.bytes_down,
+            'duration': round(now - self.started, 1),
+            'idle': round(now - self.last_active, 1),
+        }
+
+class TunnelReactor:
+    """Upgrade 後のトンネルを1つのスレッドの selectors ループで中継する
+
+    方向ごとにスレッドを使わず、ノンブロッキングのソケットを読み書き可能に
+    なった時点で処理する。相手側に送り切れないデータがある間は読み込みを
+    止めるので、バッファはトンネルごとに1チャンクまでになる。
+    """
+
+    def __init__(self, max_tunnels=DEFAULT_MAX_TUNNELS, idle_timeout=DEFAULT_TUNNEL_IDLE_TIMEOUT):
+        self.max_tunnels = max_tunnels
+        self.idle_timeout = idle_timeout
+        self.selector = None
+        self.tunnels = set()
+        self.reserved = 0
+        self.opened = 0
+        self.closed_bytes_up = 0
+        self.closed_bytes_down = 0
+        self._incoming = []
+        self._lock = threading.Lock()
+        self._wakeup = None
+
+    def reserve(self):
+        """トンネル1つ分の枠を確保する。上限に達していれば False"""
+        with self._lock:
+            if self.reserved >= self.max_tunnels:
+                return False
+            self.reserved += 1
+            return True
+
+    def unreserve(self):
+        with self._lock:
+            self.reserved -= 1
+
+    def open(self, client, backend, initial, label, on_close, upstream=b''):
+        """確保済みの枠でトンネルを開始する
+
+        initial はバックエンドから、upstream はクライアントから受信済みでまだ相手に
+        送っていないデータ。
+        """
+        client.setblocking(False)
+        backend.setblocking(False)
+        tunnel = Tunnel(client, backend, label, on_close)
+        tunnel.pending[client] = initial
+        tunnel.pending[backend] = upstream
+        tunnel.bytes_down += len(initial)
+        tunnel.bytes_up += len(upstream)
+        with self._lock:
+            if self.selector is None:
+                self.selector = selectors.DefaultSelector()
+                self._wakeup = socket.socketpair()
+                self._wakeup[0].setblocking(False)
+                self.selector.register(self._wakeup[0], selectors.EVENT_READ)
+                threading.Thread(target=self._run, name='lpg-tunnels', daemon=True).start()
+            self._incoming.append(tunnel)
+            self.opened += 1
+        self._wakeup[1].send(b'\0')
+
+    def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            for key, mask in self.selector.select(timeout=1):
+                if key.data is None:
+                    self._accept_incoming()
+                    continue
+                tunnel = key.data
+                if tunnel not in self.tunnels:
+                    continue
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(tunnel, key.fileobj)
+                    if mask & selectors.EVENT_READ and tunnel in self.tunnels:
+                        self._read(tunnel, key.fileobj)
+                except OSError as e:
+                    logger.debug(f"Tunnel {tunnel.label} error: {e}")
+                    self._close(tunnel)
+            
+            now = time.monotonic()
+            if now - last_sweep >= 1:
+                last_sweep = now
+                for tunnel in [t for t in self.tunnels if now - t.last_active > self.idle_timeout]:
+                    logger.info(f"Tunnel {tunnel.label} idle for {self.idle_timeout}s, closing")
+                    self._close(tunnel)
+
+    def _accept_incoming(self):
+        try:
+            while self._wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+        for tunnel in incoming:
+            self.tunnels.add(tunnel)
+            try:
+                for sock in (tunnel.client, tunnel.backend):
+                    if tunnel.pending[sock]:
+                        self._flush(tunnel, sock)
+                self._update(tunnel)
+            except OSError:
+                self._close(tunnel)
+
+    def _read(self, tunnel, sock):
+        data = sock.recv(TUNNEL_BUFFER_SIZE)
+        if not data:
+            self._close(tunnel)
+            return
+        tunnel.last_active = time.monotonic()
+        if sock is tunnel.client:
+            tunnel.bytes_up += len(data)
+        else:
+            tunnel.bytes_down += len(data)
+        peer = tunnel.peer(sock)
+        tunnel.pending[peer] = data
+        self._flush(tunnel, peer)
+
+    def _flush(self, tunnel, sock):
+        data = tunnel.pending[sock]
+        if data:
+            try:
+                sent = sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            tunnel.pending[sock] = data[sent:]
+        self._update(tunnel)
+
+    def _update(self, tunnel):
+        """未送信データの有無に合わせてセレクタの登録を更新する"""
+        for sock in (tunnel.client, tunnel.backend):
+            events = 0
+            if not tunnel.pending[tunnel.peer(sock)]:
+                events |= selectors.EVENT_READ
+            if tunnel.pending[sock]:
+                events |= selectors.EVENT_WRITE
+            current = tunnel.events[sock]
+            if events == current:
+                continue
+            if not current:
+                self.selector.register(sock, events, tunnel)
+            elif not events:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, events, tunnel)
+            tunnel.events[sock] = events
+
+    def _close(self, tunnel):
+        if tunnel not in self.tunnels:
+            return
+        self.tunnels.discard(tunnel)
+        for sock in (tunnel.client, tunnel.backend):
+            if tunnel.events[sock]:
+                self.selector.unregister(sock)
+            try:
+                sock.close()
+            except OSError:
+                pass
+        with self._lock:
+            self.reserved -= 1
+            self.closed_bytes_up += tunnel.bytes_up
+            self.closed_bytes_down += tunnel.bytes_down
+        logger.info(f"Tunnel {tunnel.label} closed (up={tunnel.bytes_up} down={tunnel.bytes_down} "
+                    f"duration={time.monotonic() - tunnel.started:.1f}s)")
+        try:
+            tunnel.on_close()
+        except Exception as e:
+            logger.error(f"Tunnel close callback failed: {e}")
+
+    def account(self, bytes_up, bytes_down):
+        """asyncio エンジンが中継し終えたトンネルを集計に加える"""
+        with self._lock:
+            self.opened += 1
+            self.closed_bytes_up += bytes_up
+            self.closed_bytes_down += bytes_down
+
+    def stats(self):
+        tunnels = [t.stats() for t in list(self.tunnels)]
+        with self._lock:
+            return {
+                'active': len(tunnels),
+                'max_tunnels': self.max_tunnels,
+                'opened': self.opened,
+                'bytes_up': self.closed_bytes_up + sum(t['bytes_up'] for t in tunnels),
+                'bytes_down': self.closed_bytes_down + sum(t['bytes_down'] for t in tunnels),
+                'tunnels': tunnels,
+            }
+
+tunnels = TunnelReactor()
+
+def read_http_head(sock, limit=MAX_HEADER_BYTES):
+    """ブロッキングのソケットからヘッダー部を読み、(ヘッダー, 残りのデータ) を返す"""
+    data = b''
+    while b'\r\n\r\n' not in data:
+        if len(data) > limit:
+            raise ValueError("Response header too large")
+        chunk = sock.recv(TUNNEL_BUFFER_SIZE)
+        if not chunk:
+            raise ConnectionError("Backend closed connection during handshake")
+        data += chunk
+    head, _, rest = data.partition(b'\r\n\r\n')
+    return head, rest
+
+class CompressSpec:
+    """ルールの compress 設定（テキスト系レスポンスの gzip 圧縮）"""
+    __slots__ = ('min_size', 'level', 'types')
+
+    def __init__(self, spec):
+        self.min_size = int(spec.get('min_size', DEFAULT_COMPRESS_MIN_SIZE))
+        self.level = int(spec.get('level', DEFAULT_COMPRESS_LEVEL))
+        self.types = tuple(t.lower() for t in spec.get('types', DEFAULT_COMPRESS_TYPES))
+
+    @classmethod
+    def from_rule(cls, rule):
+        spec = rule.get('compress')
+        if spec is True:
+            return cls({})
+        if isinstance(spec, Mapping) and spec.get('enabled', True):
+            return cls(spec)
+        return None
+
+    def applies(self, status, header, length):
+        """レスポンスを圧縮するかどうか（header は名前から値を返す関数）"""
+        if status < 200 or status in (204, 206, 304) or header('Content-Encoding'):
+            return False
+        if length is not None and length < self.min_size:
+            return False
+        if 'no-transform' in parse_cache_control(header('Cache-Control')):
+            return False
+        content_type = (header('Content-Type') or '').split(';')[0].strip().lower()
+        return any(content_type.startswith(t) if t.endswith('/') else content_type == t
+                   for t in self.types)
+
+    def compressor(self):
+        # wbits=31 で gzip 形式のストリームを出力する
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+def accepts_gzip(value):
+    """Accept-Encoding で gzip が受け入れられるか"""
+    for part in (value or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if coding.strip().lower() not in ('gzip', '*'):
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+def gzip_headers(headers):
+    """圧縮後のレスポンスヘッダー（ETag を弱い比較用にし、Vary に Accept-Encoding を足す）"""
+    result = []
+    vary = None
+    for header, value in headers:
+        lower = header.lower()
+        if lower == 'etag' and not value.startswith('W/'):
+            value = 'W/' + value
+        elif lower == 'vary':
+            vary = value
+            continue
+        result.append((header, value))
+    if vary is None:
+        vary = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        vary += ', Accept-Encoding'
+    result.append(('Vary', vary))
+    result.append(('Content-Encoding', 'gzip'))
+    return result
+
+def etag_matches(etag, if_none_match):
+    """If-None-Match の弱い比較"""
+    if not etag or not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith('W/') else tag) == opaque:
+            return True
+    return False
+
+class CompressedVariants:
+    """キャッシュ済みレスポンスの gzip 版を保持する小さな LRU"""
+
+    def __init__(self, max_size=DEFAULT_COMPRESS_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._variants = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0}
+
+    def get(self, entry, spec):
+        """エントリのボディを圧縮したものを返す（なければ圧縮して保持する）"""
+        key = (id(entry), entry.stored_at, entry.length, spec.level)
+        with self._lock:
+            body = self._variants.get(key)
+            if body is not None:
+                self._variants.move_to_end(key)
+                self.counters['hits'] += 1
+                return body
+            self.counters['misses'] += 1
+        compressor = spec.compressor()
+        body = compressor.compress(entry.body) + compressor.flush()
+        if len(body) <= self.max_size:
+            with self._lock:
+                if key not in self._variants:
+                    self._variants[key] = body
+                    self.size += len(body)
+                while self.size > self.max_size:
+                    _, old = self._variants.popitem(last=False)
+                    self.size -= len(old)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._variants.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._variants), size=self.size,
+                        max_size=self.max_size)
+
+compressed_variants = CompressedVariants()
+
+class BufferPool:
+    """中継用 bytearray を使い回すためのプール"""
+
+    def __init__(self, size, max_free):
+        self.size = size
+        self.max_free = max_free
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buf):
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buf)
+
+relay_buffers = BufferPool(RELAY_BUFFER_SIZE, DEFAULT_PROXY_WORKERS)
+
+# スレッドごとに保持する splice 用パイプ
+_splice_local = threading.local()
+
+def splice_pipe():
+    """このスレッドの splice 用パイプ (read_fd, write_fd) を返す"""
+    pipe = getattr(_splice_local, 'pipe', None)
+    if pipe is None:
+        pipe = os.pipe()
+        try:
+            fcntl.fcntl(pipe[1], fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+        except (OSError, AttributeError):
+            pass
+        _splice_local.pipe = pipe
+    return pipe
+
+def drop_splice_pipe():
+    """このスレッドの splice 用パイプを閉じる"""
+    pipe = getattr(_splice_local, 'pipe', None)
+    if pipe is not None:
+        os.close(pipe[0])
+        os.close(pipe[1])
+        _splice_local.pipe = None
+
+def splice_once(fd_in, fd_out, count, wait_fd, events, timeout):
+    """os.splice を1回実行する。ノンブロッキングソケットでは準備完了まで待つ"""
+    while True:
+        try:
+            return os.splice(fd_in, fd_out, count, flags=os.SPLICE_F_MOVE)
+        except BlockingIOError:
+            poller = select.poll()
+            poller.register(wait_fd, events)
+            if not poller.poll(None if timeout is None else timeout * 1000):
+                raise TimeoutError("splice timed out")
+
+class RequestBodyError(Exception):
+    """リクエストボディが不正または上限超過（status はクライアントに返すコード）"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def parse_chunk_size(line):
+    """chunked のサイズ行からチャンクの長さを返す（不正な行は ValueError）"""
+    match = CHUNK_SIZE_PATTERN.fullmatch(line)
+    if match is None:
+        raise ValueError(f"Invalid chunk size line: {line[:32]!r}")
+    return int(match.group(1), 16)
+
+class PoolTimeout(Exception):
+    """接続プールから接続を取得できなかった"""
+
+class BackendConnectionPool:
+    """(ip, port) ごとに HTTP/1.1 の持続的接続を保持するプール
+
+    max_idle はキーごとに保持するアイドル接続数、max_total はキーごとの
+    同時接続数の上限。idle_timeout を過ぎたアイドル接続は閉じられる。
+    """
+
+    def __init__(self, max_idle=DEFAULT_POOL_MAX_IDLE, max_total=DEFAULT_POOL_MAX_TOTAL,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT, timeout=BACKEND_TIMEOUT):
+        self.max_idle = max_idle
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._total = {}
+        self._next_sweep = 0.0
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.stale = 0
+
+    def acquire(self, ip, port):
+        """接続を取得する。(conn, reused) を返す"""
+        key = (ip, port)
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self._sweep()
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    conn, last_used = idle.pop()
+                    if time.monotonic() - last_used > self.idle_timeout or self._is_stale(conn):
+                        self._discard(key, conn)
+                        continue
+                    self.reused += 1
+                    return conn, True
+                if self._total.get(key, 0) < self.max_total:
+                    self._total[key] = self._total.get(key, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    raise PoolTimeout(f"No free connection to {ip}:{port}")
+        self.created += 1
+        return http.client.HTTPConnection(ip, port, timeout=self.timeout), False
+
+    def release(self, conn, reusable):
+        """接続を返却する。reusable=False の場合は閉じる"""
+        key = (conn.host, conn.port)
+        with self._cond:
+            idle = self._idle.setdefault(key, [])
+            if reusable and conn.sock is not None and len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+            else:
+                self._discard(key, conn)
+            self._cond.notify()
+
+    def _discard(self, key, conn):
+        conn.close()
+        self._total[key] = self._total.get(key, 1) - 1
+
+    def _is_stale(self, conn):
+        """アイドル中にバックエンドから切断された接続を検出する"""
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        if readable:
+            self.stale += 1
+        return bool(readable)
+
+    def _sweep(self):
+        """idle_timeout を過ぎたアイドル接続を閉じる（ロック保持中に呼ぶ）"""
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + max(self.idle_timeout / 2, 1)
+        for key, idle in self._idle.items():
+            while idle and now - idle[0][1] > self.idle_timeout:
+                conn, _ = idle.pop(0)
+                self._discard(key, conn)
+                self.evicted += 1
+
+    def stats(self):
+        """プールの使用状況を返す"""
+        with self._cond:
+            self._sweep()
+            backends = {}
+            for key, total in self._total.items():
+                idle = len(self._idle.get(key, ()))
+                backends[f"{key[0]}:{key[1]}"] = {
+                    'idle': idle,
+                    'active': total - idle,
+                    'total': total,
+                }
+            return {
+                'max_idle': self.max_idle,
+                'max_total': self.max_total,
+                'idle_timeout': self.idle_timeout,
+                'created': self.created,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'stale': self.stale,
+                'backends': backends,
+            }
+
+backend_pool = BackendConnectionPool()
+
+class BoundedWorkerPool:
+    """固定数のワーカースレッドと上限付きキューで接続を処理する"""
+
+    def __init__(self, target, workers, queue_size, name='lpg-worker'):
+        self.target = target
+        self.tasks = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, *args):
+        """タスクを投入する。キューが満杯ならFalseを返す"""
+        try:
+            self.tasks.put_nowait(args)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        while True:
+            args = self.tasks.get()
+            if args is None:
+                break
+            try:
+                self.target(*args)
+            except Exception as e:
+                logger.error(f"Worker error: {e}")
+
+    def shutdown(self):
+        """全ワーカーに終了を通知する"""
+        for _ in self.threads:
+            self.tasks.put(None)
+
+class AccessLog:
+    """構造化アクセスログをバックグラウンドスレッドでまとめて書き出す
+
+    リクエストスレッドはレコードをキューに積むだけで、書き込みは専用スレッドが
+    溜まった分をまとめて行う。キューが満杯のときは policy に従い、'drop' なら
+    レコードを捨てて dropped を数え、'block' なら空くまで待つ。
+    ファイルは max_size を超えるか rotate_interval 秒経つと .1 .. .max_files に
+    ローテーションする。path が空の場合はロガーに出力する。
+    複数のワーカープロセスが同じファイルに追記するため、ローテーションは
+    ロックファイルで排他し、他のプロセスが差し替えたファイルは開き直す。
+    """
+
+    def __init__(self):
+        self.path = None
+        self.max_size = DEFAULT_ACCESS_LOG_MAX_SIZE
+        self.max_files = DEFAULT_ACCESS_LOG_MAX_FILES
+        self.rotate_interval = DEFAULT_ACCESS_LOG_ROTATE_INTERVAL
+        self.policy = DEFAULT_ACCESS_LOG_POLICY
+        self.queue = queue.Queue(DEFAULT_ACCESS_LOG_QUEUE_SIZE)
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.errors = 0
+        self._file = None
+        self._opened_at = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def configure(self, spec):
+        self.path = spec.get('path', DEFAULT_ACCESS_LOG_PATH) or None
+        self.max_size = int(spec.get('max_size', DEFAULT_ACCESS_LOG_MAX_SIZE))
+        self.max_files = int(spec.get('max_files', DEFAULT_ACCESS_LOG_MAX_FILES))
+        self.rotate_interval = float(spec.get('rotate_interval', DEFAULT_ACCESS_LOG_ROTATE_INTERVAL))
+        self.policy = spec.get('policy', DEFAULT_ACCESS_LOG_POLICY)
+        self.queue = queue.Queue(int(spec.get('queue_size', DEFAULT_ACCESS_LOG_QUEUE_SIZE)))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='lpg-access-log', daemon=True)
+            self._thread.start()
+
+    def log(self, record):
+        """レコードをキューに積む（書き込みスレッドが未起動ならロガーへ直接出力）"""
+        if self._thread is None:
+            logger.info(self.format(record).rstrip())
+            return
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < ACCESS_LOG_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = ''.join(self.format(record) for record in batch)
+            try:
+                self._write(lines)
+                self.written += len(batch)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Access log write failed: {e}")
+                self._close()
+                time.sleep(1)
+
+    @staticmethod
+    def format(record):
+        """1レコードを JSON の1行にする（時刻の整形も書き込みスレッド側で行う）"""
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(record['time']))
+        return json.dumps(record, ensure_ascii=False) + '\n'
+
+    def _write(self, lines):
+        if self.path is None:
+            for line in lines.splitlines():
+                logger.info(line)
+            return
+        if self._file is not None and self._replaced():
+            self._close()
+        if self._file is None:
+            self._open()
+        if self._rotation_due(len(lines)):
+            self._rotate(len(lines))
+        self._file.write(lines)
+        self._file.flush()
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if not self._opened_at:
+            self._opened_at = time.time()
+
+    def _replaced(self):
+        """他のプロセスのローテーションでファイルが差し替わったか"""
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except OSError:
+            return True
+
+    def _rotation_due(self, pending):
+        if os.fstat(self._file.fileno()).st_size + pending > self.max_size:
+            return True
+        # 最後のローテーション時刻は .1 の mtime で全プロセスが共有する
+        try:
+            rotated_at = os.stat(f"{self.path}.1").st_mtime
+        except OSError:
+            rotated_at = self._opened_at
+        return time.time() - rotated_at > self.rotate_interval
+
+    def _rotate(self, pending):
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # ロック待ちの間に他のプロセスがローテーションしていれば開き直すだけにする
+            if self._replaced():
+                self._close()
+                self._open()
+                if not self._rotation_due(pending):
+                    return
+            self._close()
+            for i in range(self.max_files - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            if self.max_files > 0:
+                os.replace(self.path, f"{self.path}.1")
+                os.utime(f"{self.path}.1")
+            else:
+                os.remove(self.path)
+                self._opened_at = time.time()
+            self._open()
+        self.rotations += 1
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def flush(self, timeout):
+        """終了前にキューが空になるまで待つ"""
+        deadline = time.monotonic() + timeout
+        while self._thread is not None and not self.queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def stats(self):
+        return {'path': self.path, 'policy': self.policy, 'queued': self.queue.qsize(),
+                'written': self.written, 'dropped': self.dropped,
+                'rotations': self.rotations, 'errors': self.errors}
+
+access_log = AccessLog()
+
+class Metrics:
+    """Prometheus 形式で公開するカウンターとヒストグラム
+
+    記録はスレッドごとのシャード（dict）を更新するだけでロックを取らず、
+    /__lpg/metrics の取得時に全シャードを合算する。ワーカースレッドは固定数なので
+    シャードはスレッド終了後も合算対象として残す。
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """ヒストグラムに記録する（[バケットごとの件数..., +Inf, 合計] の形で保持）"""
+        histograms = self._shard()[1]
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def observe_request(self, host, route, status, duration, bytes_received, bytes_sent):
+        """1リクエスト分を記録する（status が None はクライアント切断などで応答なし）"""
+        labels = (('host', host), ('route', route))
+        code = f"{int(status) // 100}xx" if status else 'none'
+        self.inc('lpg_requests_total', labels + (('code', code),))
+        self.observe('lpg_request_duration_seconds', labels, duration)
+        if bytes_received:
+            self.inc('lpg_request_body_bytes_total', labels, bytes_received)
+        if bytes_sent:
+            self.inc('lpg_response_body_bytes_total', labels, bytes_sent)
+
+    def snapshot(self):
+        """全シャードを合算した (counters, histograms) を返す"""
+        with self._lock:
+            shards = list(self._shards)
+        counters = {}
+        histograms = {}
+        for shard_counters, shard_histograms in shards:
+            # dict.copy() は GIL を保持したまま行われるので書き込み中でも安全
+            for key, value in shard_counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for key, counts in shard_histograms.copy().items():
+                total = histograms.setdefault(key, [0] * len(counts))
+                for i, value in enumerate(list(counts)):
+                    total[i] += value
+        return counters, histograms
+
+    def render(self, gauges=()):
+        """テキスト形式（text/plain; version=0.0.4）で出力する
+
+        gauges は取得時点の値を表す (name, type, help, [(labels, value), ...]) の並び。
+        """
+        counters, histograms = self.snapshot()
+        families = {}
+        for (name, labels), value in counters.items():
+            families.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(families):
+            kind, text = METRIC_HELP.get(name, ('counter', name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(families[name]):
+                lines.append(f"{name}{format_labels(labels)} {format_metric_value(value)}")
+        for name, kind, text, samples in gauges:
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_metric_value(value)}")
+        for name in sorted({name for name, _ in histograms}):
+            kind, text = METRIC_HELP.get(name, ('histogram', name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (_, labels), counts in sorted(item for item in histograms.items() if item[0][0] == name):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = format_metric_value(bound) if bound != '+Inf' else bound
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_metric_value(counts[-1])}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+METRIC_HELP = {
+    'lpg_requests_total': ('counter', 'Requests handled, by host, route and status class'),
+    'lpg_request_duration_seconds': ('histogram', 'Time from request head to the end of the response'),
+    'lpg_request_body_bytes_total': ('counter', 'Request body bytes received from clients'),
+    'lpg_response_body_bytes_total': ('counter', 'Response body bytes sent to clients'),
+    'lpg_connections_opened_total': ('counter', 'Client connections accepted by a worker'),
+    'lpg_connections_closed_total': ('counter', 'Client connections finished by a worker'),
+    'lpg_rate_limited_total': ('counter', 'Requests rejected with 429, by limit scope'),
+    'lpg_connections_rejected_total': ('counter', 'Client connections rejected with 503 while the pool was saturated'),
+}
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def format_metric_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+metrics = Metrics()
+
+def active_connections():
+    """このプロセスで処理中のクライアント接続数（トンネルを含む）"""
+    counters, _ = metrics.snapshot()
+    return (counters.get(('lpg_connections_opened_total', ()), 0)
+            - counters.get(('lpg_connections_closed_total', ()), 0)
+            + tunnels.stats()['active'])
+
+def proxy_gauges():
+    """取得時点の状態（接続数・プール・バックエンド・トンネル・キャッシュ）をゲージにする"""
+    counters, _ = metrics.snapshot()
+    active = (counters.get(('lpg_connections_opened_total', ()), 0)
+              - counters.get(('lpg_connections_closed_total', ()), 0))
+    pool = backend_pool.stats()
+    pool_connections = []
+    for backend, stat in pool['backends'].items():
+        pool_connections.append(((('backend', backend), ('state', 'idle')), stat['idle']))
+        pool_connections.append(((('backend', backend), ('state', 'active')), stat['active']))
+    backend_stats = backends.stats()
+    tunnel_stats = tunnels.stats()
+    cache_stats = response_cache.stats()
+    budget = retry_budget.stats()
+    return [
+        ('lpg_active_connections', 'gauge', 'Client connections currently held by workers',
+         [((), active)]),
+        ('lpg_backend_pool_connections', 'gauge', 'Pooled backend connections by state',
+         pool_connections),
+        ('lpg_backend_pool_events_total', 'counter', 'Backend pool connection events',
+         [((('event', event),), pool[event]) for event in ('created', 'reused', 'evicted', 'stale')]),
+        ('lpg_backend_outstanding_requests', 'gauge', 'Requests in progress per backend',
+         [((('backend', b),), stat['outstanding']) for b, stat in backend_stats.items()]),
+        ('lpg_backend_circuit_open', 'gauge', 'Whether the backend circuit breaker is open',
+         [((('backend', b),), int(stat['circuit'] == 'open')) for b, stat in backend_stats.items()]),
+        ('lpg_tunnels_active', 'gauge', 'Upgraded connections being relayed',
+         [((), tunnel_stats['active'])]),
+        ('lpg_tunnel_bytes_total', 'counter', 'Bytes relayed through tunnels',
+         [((('direction', 'up'),), tunnel_stats['bytes_up']),
+          ((('direction', 'down'),), tunnel_stats['bytes_down'])]),
+        ('lpg_cache_events_total', 'counter', 'Response cache lookups and stores',
+         [((('event', event),), cache_stats[event])
+          for event in ('hits', 'stale', 'misses', 'bypasses', 'stores', 'evictions', 'revalidations',
+                        'revalidations_dropped')]),
+        ('lpg_cache_size_bytes', 'gauge', 'Bytes held by the memory cache',
+         [((), cache_stats['size'])]),
+        ('lpg_access_log_dropped_total', 'counter', 'Access log records dropped with a full queue',
+         [((), access_log.dropped)]),
+        ('lpg_retries_total', 'counter', 'Backend retries, by outcome of the retry budget',
+         [((('result', 'allowed'),), budget['retries']),
+          ((('result', 'exhausted'),), budget['exhausted'])]),
+    ]
+
+class LPGProxyServer(HTTPServer):
+    """上限付きワーカープールで並行処理するHTTPサーバー
+
+    ワーカーとキューが共に埋まっている場合は、リッスンバックログに
+    接続を溜めずに即座に 503 + Retry-After を返す。
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_PROXY_WORKERS,
+                 queue_size=DEFAULT_PROXY_QUEUE_SIZE, retry_after=DEFAULT_PROXY_RETRY_AFTER,
+                 listen_socket=None):
+        super().__init__(server_address, handler_class, bind_and_activate=listen_socket is None)
+        if listen_socket is not None:
+            # 親プロセスや旧プロセスから引き継いだ待ち受けソケットを使う。
+            # 他のプロセスも同じソケットで accept するので、取り合いに負けても
+            # accept で止まらないようノンブロッキングにする（失敗は socketserver が無視する）
+            self.socket.close()
+            listen_socket.setblocking(False)
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+            self.server_name, self.server_port = self.server_address[:2]
+        self.retry_after = retry_after
+        self.draining = False
+        self._detached = set()
+        self._detached_lock = threading.Lock()
+        self.pool = BoundedWorkerPool(self.process_request_worker, workers, queue_size)
+
+    def is_busy(self):
+        """ワーカー待ちの接続があるか"""
+        return not self.pool.tasks.empty()
+
+    def detach_request(self, request):
+        """トンネルに引き渡した接続をハンドラー終了時に閉じないようにする"""
+        with self._detached_lock:
+            self._detached.add(request)
+
+    def shutdown_request(self, request):
+        with self._detached_lock:
+            if request in self._detached:
+                self._detached.discard(request)
+                return
+        super().shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.pool.submit(request, client_address):
+            logger.warning(f"Worker pool saturated, rejecting {client_address[0]}")
+            self.reject_busy(request)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def reject_busy(self, request):
+        """プール飽和時に 503 を返して接続を閉じる"""
+        metrics.inc('lpg_connections_rejected_total')
+        body = b"Proxy is busy, please retry later\n"
+        response = (
+            "HTTP/1.1 503 Service Unavailable\r\n"
+            f"Retry-After: {self.retry_after}\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        ).encode('latin-1') + body
+        try:
+            request.settimeout(1)
+            request.sendall(response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+    def begin_drain(self):
+        """新しい接続の受け付けを止める（serve_forever を抜けさせる）"""
+        self.draining = True
+        self.shutdown()
+
+    def pending(self):
+        """処理中・処理待ちの接続数"""
+        return active_connections() + self.pool.tasks.qsize()
+
+class LPGProxyHandler(BaseHTTPRequestHandler):
+    # クライアントとの keep-alive を有効にする（アイドル時間は timeout で制限）
+    protocol_version = 'HTTP/1.1'
+    timeout = DEFAULT_KEEPALIVE_TIMEOUT
+    # ヘッダーとボディを別々に書き込むため Nagle を無効化する
+    disable_nagle_algorithm = True
+    
+    def load_config(self):
+        """現在の設定スナップショットを返す"""
+        return load_config()
     
     def do_GET(self):
         self.handle_request()
@@ -45,137 +2971,1963 @@ class LPGProxyHandler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         self.handle_request()
     
-    def do_PATCH(self):
-        self.handle_request()
+    def do_PATCH(self):
+        self.handle_request()
+    
+    def setup(self):
+        super().setup()
+        metrics.inc('lpg_connections_opened_total')
+    
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+    
+    def wait_for_request(self):
+        """keep-alive 接続で次のリクエストを待つ（届いたら True）
+
+        アイドルな接続はワーカーを占有するので、ワーカー待ちの接続があるときや
+        リロードで排出中のときは timeout を待たずに閉じてワーカーを譲る。
+        """
+        # 先読み済み（パイプライン）のリクエストがあればすぐ処理する
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        
+        server_busy = getattr(self.server, 'is_busy', None)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.connection], [], [],
+                                           min(remaining, KEEPALIVE_POLL_INTERVAL))
+            if readable:
+                return True
+            if getattr(self.server, 'draining', False) or (server_busy is not None and server_busy()):
+                return False
+    
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            metrics.inc('lpg_connections_closed_total')
     
     def handle_request(self):
-        """リクエストを処理してバックエンドに転送"""
-        config = self.load_config()
+        """リクエストを処理し、メトリクスとアクセスログを記録する"""
+        started = time.monotonic()
+        self.status = None
+        self.route_labels = ('', '')
+        self.backend = None
+        self.upstream_time = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        try:
+            self.route_request()
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.observe_request(*self.route_labels, self.status, elapsed,
+                                    self.bytes_received, self.bytes_sent)
+            access_log.log({
+                'time': time.time(),
+                'client': self.client_address[0],
+                'method': self.command,
+                'path': self.path,
+                'host': self.route_labels[0],
+                'route': self.route_labels[1],
+                'backend': self.backend,
+                'status': self.status,
+                'bytes_in': self.bytes_received,
+                'bytes_out': self.bytes_sent,
+                'cache': self.cache_status,
+                'upstream_time': None if self.upstream_time is None else round(self.upstream_time, 4),
+                'total_time': round(elapsed, 4),
+            })
+    
+    def log_request(self, code='-', size='-'):
+        """ステータスを記録する（アクセスログは handle_request でまとめて出力する）"""
+        if isinstance(code, int):
+            self.status = code
+    
+    def route_request(self):
+        """リクエストをルーティングしてバックエンドに転送"""
+        self.cache_key = None
+        self.cache_status = None
+        self.stale_entry = None
+        self.flight = None
+        self.compress = None
+        self.timeouts = None
+        self.deadline = None
+        self.backend_sock = None
+        snapshot = self.load_config()
         host = self.headers.get('Host', '').split(':')[0]
         path = self.path
         
-        # ホストドメインの確認
-        if host not in config.get('hostdomains', {}):
-            self.send_error(404, "Domain not configured")
+        # ルーティングやバックエンドの処理より前にレート制限を掛ける
+        ip = client_ip(self.headers.get, self.client_address[0])
+        wait = check_rate_limits(snapshot, None, ip)
+        if wait:
+            self.send_rate_limited(wait)
             return
         
-        # パスベースのルーティング
-        hosting_rules = config.get('hostingdevice', {}).get(host, {})
+        try:
+            route, backend_path = resolve_route(snapshot, host, path)
+        except RouteError as e:
+            self.send_error(e.status, e.message)
+            return
+        self.route_labels = (route.host, route.prefix)
         
-        # 最長一致でルールを検索
-        matched_rule = None
-        matched_path = ""
-        for rule_path in sorted(hosting_rules.keys(), key=len, reverse=True):
-            if path.startswith(rule_path):
-                matched_rule = hosting_rules[rule_path]
-                matched_path = rule_path
-                break
+        if route.allow is not None and not route.allow.allows(ip):
+            logger.debug(f"Denied {ip} for {host}{route.prefix} by ips")
+            self.send_error(403, "Forbidden")
+            return
         
-        if not matched_rule:
-            self.send_error(404, "Path not configured")
+        wait = check_rate_limits(snapshot, route, ip)
+        if wait:
+            self.send_rate_limited(wait)
             return
         
-        # バックエンドのIPとポートを取得
-        backend_ip = matched_rule.get('deviceip')
-        backend_ports = matched_rule.get('port', [])
+        # gzip を受け付けるクライアントにだけ圧縮を適用する
+        if (route.compress is not None and self.command != 'HEAD'
+                and accepts_gzip(self.headers.get('Accept-Encoding'))):
+            self.compress = route.compress
         
-        if not backend_ip or not backend_ports:
-            self.send_error(502, "Backend not configured")
+        # Upgrade（WebSocket など）はトンネルとして中継する
+        if 'upgrade' in self.connection_tokens() and self.headers.get('Upgrade'):
+            self.handle_upgrade(route, backend_path, host, path)
             return
         
-        # 最初のポートを使用（複数ポートの場合は負荷分散を実装可能）
-        backend_port = backend_ports[0] if backend_ports else 80
+        # キャッシュから応答できる場合はバックエンドを選ばない
+        if route.cache is not None and self.lookup_cache(route, backend_path, host, path):
+            return
         
-        # パスの書き換え：プレフィックスを削除
-        # /lacisstack/boards/xxx -> /xxx
-        # /lacisstack/boards -> /
-        # /lacisstack/boards/ -> /
-        if matched_path and matched_path != '/':
-            # matched_pathを削除してバックエンドパスを生成
-            if path.startswith(matched_path):
-                # パスからプレフィックスを削除
-                backend_path = path[len(matched_path.rstrip('/')):]
-                if not backend_path or backend_path == '/':
-                    backend_path = '/'
-                elif not backend_path.startswith('/'):
-                    backend_path = '/' + backend_path
+        # 同じ GET が進行中ならその応答を共有する（Cookie 付きはユーザーごとの応答になりうるので除く）
+        flight_key = None
+        if (route.coalesce and self.command == 'GET' and not self.headers.get('Cookie')
+                and request_cache_mode(self.headers) != 'bypass'):
+            # 条件付きリクエストは同じ条件のものだけをまとめる
+            flight_key = (self.cache_key or cache_key(route, backend_path),
+                          self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since'))
+            flight, leader = flights.begin(flight_key, self.headers)
+            if not leader:
+                flight_key = None
+                if self.follow_flight(flight):
+                    return
             else:
-                backend_path = path
-        else:
-            backend_path = path
-        
-        # バックエンドURLを構築
-        backend_url = f"http://{backend_ip}:{backend_port}{backend_path}"
+                self.flight = flight
         
-        logger.info(f"Proxying {self.command} {path} -> {backend_url}")
+        try:
+            self.proxy_request(route, backend_path, host, path)
+        finally:
+            if flight_key is not None:
+                flights.end(flight_key, self.flight, failed=not self.flight.done)
+    
+    def proxy_request(self, route, backend_path, host, path):
+        """バックエンドを選んでリクエストを転送する"""
+        try:
+            backend = select_backend(route, path, self.headers.get, self.client_address[0])
+        except RouteError as e:
+            if not self.serve_stale(e.message):
+                self.send_error(e.status, e.message)
+            return
         
+        # リクエストボディのフレーミングを確認（上限超過はバックエンドに接続する前に 413）
         try:
-            # リクエストをバックエンドに転送
-            req = urllib.request.Request(backend_url, method=self.command)
-            
-            # ヘッダーをコピー（Host以外）
-            for header, value in self.headers.items():
-                if header.lower() not in ['host', 'connection']:
-                    req.add_header(header, value)
+            body_length, body_chunked = self.request_body_framing(route.max_body_size)
+        except RequestBodyError as e:
+            self.send_error(e.status, e.message)
+            return
+        self.send_continue()
+        
+        # ボディのない冪等リクエストだけを別のバックエンドで再試行する
+        self.timeouts = route.timeouts
+        self.deadline = route.timeouts.deadline()
+        retryable = self.command in IDEMPOTENT_METHODS and not body_chunked and not body_length
+        retry_budget.deposit()
+        tried = []
+        while True:
+            logger.debug(f"Proxying {self.command} {path} -> http://{backend}{backend_path}")
+            self.backend = str(backend)
             
-            # プロキシヘッダーを追加
-            req.add_header('X-Forwarded-For', self.client_address[0])
-            req.add_header('X-Forwarded-Host', host)
-            req.add_header('X-Forwarded-Proto', 'https')
-            req.add_header('X-Real-IP', self.client_address[0])
-            req.add_header('X-Original-Path', path)
+            permit = backend.begin(route.breaker)
+            if permit is None:
+                if not self.serve_stale("Backend circuit open"):
+                    self.send_error(503, "Backend circuit open")
+                return
             
-            # POSTデータがある場合
-            if self.command in ['POST', 'PUT', 'PATCH']:
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length > 0:
-                    post_data = self.rfile.read(content_length)
-                    req.data = post_data
+            tried.append(backend)
+            alternate = None
+            if (retryable and len(tried) <= route.retries.attempts
+                    and (self.deadline is None or time.monotonic() < self.deadline)):
+                alternate = route.alternate_backend(tried)
             
-            # バックエンドにリクエスト送信
-            with urllib.request.urlopen(req, timeout=30) as response:
+            ok = None
+            attempt_started = time.monotonic()
+            try:
+                ok = self.forward_request(route, backend, backend_path, host, path,
+                                          body_length, body_chunked, alternate is not None)
+                return
+            except BackendRetry as e:
+                ok = False
+                logger.warning(f"Retrying {self.command} {path} on {alternate}: {e}")
+            finally:
+                backend.end(permit, ok, route.breaker)
+                self.upstream_time = (self.upstream_time or 0) + time.monotonic() - attempt_started
+            backend = alternate
+    
+    def forward_request(self, route, backend, backend_path, host, path, body_length, body_chunked,
+                        retryable=False):
+        """バックエンドにリクエストを転送し、レスポンスをクライアントへ中継する
+
+        バックエンドの成否（5xx・接続エラー・タイムアウトは False）を返す。
+        クライアント側の問題など判定できない場合は None を返す。
+        retryable の場合、応答前の障害は再試行予算があれば BackendRetry を送出する。
+        """
+        headers_sent = False
+        ok = None
+        try:
+            conn, response = self.send_to_backend(backend, backend_path, host, path,
+                                                  body_length, body_chunked,
+                                                  route.max_body_size)
+            ok = response.status < 500
+            reusable = False
+            try:
+                if (retryable and response.status in route.retries.statuses
+                        and retry_budget.withdraw()):
+                    raise BackendRetry(f"Backend returned {response.status}")
+                
+                # バックエンドのエラーは許容範囲内の古いキャッシュで置き換える
+                if not ok and self.serve_stale(f"Backend returned {response.status}"):
+                    response.close()
+                    return ok
+                
                 # レスポンスを返す
-                self.send_response(response.code)
+                # Server/Date はバックエンドの値をそのまま使う
+                self.log_request(response.status)
+                self.send_response_only(response.status)
                 
-                # レスポンスヘッダーを転送
-                for header, value in response.headers.items():
-                    if header.lower() not in ['connection', 'transfer-encoding', 'content-encoding']:
-                        self.send_header(header, value)
+                # レスポンスヘッダーを転送（フレーミング関連はプロキシ側で付け直す）
+                response_headers = [(header, value) for header, value in response.getheaders()
+                                    if header.lower() not in RESPONSE_SKIP_HEADERS]
+                encoder = None
+                client_headers = response_headers
+                if self.compress is not None and self.compress.applies(
+                        response.status, response.headers.get, response.length):
+                    encoder = self.compress.compressor()
+                    client_headers = gzip_headers(response_headers)
+                for header, value in client_headers:
+                    self.send_header(header, value)
+                if self.cache_status:
+                    self.send_header('X-Cache', self.cache_status)
+                chunked = self.send_framing_headers(response, encoder is not None)
                 self.end_headers()
+                headers_sent = True
+                
+                # キャッシュ可能なレスポンスはボディを転送しながら保存する
+                writer = None
+                if self.cache_key is not None and route.cache is not None and self.command == 'GET':
+                    lifetime = cache_lifetime(route.cache, response.status, response.headers)
+                    limit = route.cache.capture_limit()
+                    if lifetime is not None and (response.length is None or response.length <= limit):
+                        writer = CacheWriter(route.cache, limit)
+                # socket.io のハンドシェイク応答から sid と担当バックエンドを記録する
+                recorder = None
+                if (route.affinity is not None and route.affinity.by == 'sid' and ok
+                        and 'EIO=' in path and not socketio_sid(path)):
+                    recorder = SidRecorder(route, backend)
+                sinks = [sink for sink in (writer, self.flight, recorder) if sink is not None]
+                if self.flight is not None:
+                    self.flight.publish(response.status, response_headers, response.length,
+                                        ok and response_shareable(route.cache, response.status,
+                                                                  response.headers))
                 
                 # HEADメソッドの場合はボディを送らない
                 if self.command != 'HEAD':
-                    # ボディを転送（チャンク転送）
-                    while True:
-                        chunk = response.read(8192)
-                        if not chunk:
-                            break
-                        self.wfile.write(chunk)
+                    # ボディを転送（長さ不明の場合は再チャンク化）
+                    try:
+                        self.relay_response_body(conn, response, chunked, sinks, encoder)
+                    except BaseException:
+                        if writer is not None:
+                            writer.abort()
+                        raise
+                    if writer is not None:
+                        writer.commit(self.cache_key, self.headers, response.status,
+                                      response_headers, lifetime)
+                    if self.flight is not None:
+                        self.flight.finish()
+                    if recorder is not None:
+                        recorder.commit()
+                else:
+                    response.close()
+                reusable = response.isclosed() and not response.will_close
+            finally:
+                backend_pool.release(conn, reusable)
                 
-        except urllib.error.HTTPError as e:
-            logger.error(f"Backend returned HTTP error: {e.code} {e.reason}")
-            self.send_error(e.code, e.reason)
-        except urllib.error.URLError as e:
+        except RequestBodyError as e:
+            logger.warning(f"Request body rejected: {e.status} {e.message}")
+            if headers_sent:
+                self.close_connection = True
+            else:
+                self.send_error(e.status, e.message)
+        except BackendRetry:
+            raise
+        except PoolTimeout as e:
+            logger.error(f"Backend connection pool exhausted: {e}")
+            if retryable and retry_budget.withdraw():
+                raise BackendRetry("Backend busy")
+            if not self.serve_stale("Backend busy"):
+                self.send_error(503, "Backend busy")
+        except socket.timeout as e:
+            logger.error(f"Backend timeout: {backend}: {e}")
+            if headers_sent:
+                self.close_connection = True
+            else:
+                ok = False
+                if retryable and retry_budget.withdraw():
+                    raise BackendRetry("Backend timeout")
+                if not self.serve_stale("Gateway timeout"):
+                    self.send_error(504, "Gateway timeout")
+        except OSError as e:
             logger.error(f"Backend connection error: {e}")
-            self.send_error(502, "Backend connection failed")
+            if headers_sent:
+                self.close_connection = True
+            else:
+                ok = False
+                if retryable and retry_budget.withdraw():
+                    raise BackendRetry("Backend connection failed")
+                if not self.serve_stale("Backend connection failed"):
+                    self.send_error(502, "Backend connection failed")
         except Exception as e:
             logger.error(f"Proxy error: {e}")
-            self.send_error(502, "Bad Gateway")
+            if headers_sent:
+                self.close_connection = True
+            else:
+                ok = False
+                if not self.serve_stale("Bad Gateway"):
+                    self.send_error(502, "Bad Gateway")
+        return ok
+    
+    def relay_response_body(self, conn, response, chunked, sinks=(), encoder=None):
+        """バックエンドのボディをクライアントへ中継する
+
+        長さが分かっている大きなボディはカーネル内で splice し、それ以外は
+        プールした bytearray に readinto して余計なコピーを避ける。
+        sinks（CacheWriter や Flight）を指定した場合は中継したボディを順に書き出す。
+        encoder を指定した場合はクライアントへ圧縮して送る（sinks には元のボディ）。
+        """
+        if (not sinks and encoder is None and not chunked and SPLICE_AVAILABLE
+                and response.length is not None and response.length >= SPLICE_MIN_SIZE):
+            self.splice_response_body(conn, response)
+            return
+        
+        buf = relay_buffers.acquire()
+        view = memoryview(buf)
+        try:
+            while True:
+                if self.deadline is not None:
+                    self.backend_sock.settimeout(self.timeouts.remaining(self.deadline))
+                n = response.readinto(view)
+                if not n:
+                    break
+                if encoder is not None:
+                    # ストリーミング応答が滞らないよう読み込みごとに同期フラッシュする
+                    self.write_body(encoder.compress(view[:n]) + encoder.flush(zlib.Z_SYNC_FLUSH),
+                                    chunked)
+                else:
+                    self.write_body(view[:n], chunked)
+                for sink in sinks:
+                    sink.write(view[:n])
+            if encoder is not None:
+                self.write_body(encoder.flush(), chunked)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        finally:
+            view.release()
+            relay_buffers.release(buf)
+    
+    def write_body(self, data, chunked):
+        """ボディの一部を書き込む（chunked の場合はチャンクとして）"""
+        if not data:
+            return
+        self.bytes_sent += len(data)
+        if chunked:
+            self.wfile.write(b'%x\r\n' % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b'\r\n')
+        else:
+            self.wfile.write(data)
+    
+    def splice_response_body(self, conn, response):
+        """backend socket -> pipe -> client socket をカーネル内で転送する"""
+        remaining = response.length
+        self.bytes_sent += remaining
+        
+        # ヘッダー解析時に読み込み済みのボディ先頭を先に送る
+        buffered = response.fp.peek()[:remaining]
+        if buffered:
+            self.wfile.write(response.fp.read(len(buffered)))
+            remaining -= len(buffered)
+        
+        src = self.backend_sock.fileno()
+        dst = self.connection.fileno()
+        write_timeout = self.connection.gettimeout()
+        pipe_r, pipe_w = splice_pipe()
+        try:
+            while remaining > 0:
+                n = splice_once(src, pipe_w, min(remaining, SPLICE_PIPE_SIZE),
+                                src, select.POLLIN, self.timeouts.remaining(self.deadline))
+                if n == 0:
+                    raise ConnectionError("Backend closed connection during body")
+                remaining -= n
+                while n > 0:
+                    n -= splice_once(pipe_r, dst, n, dst, select.POLLOUT, write_timeout)
+        except BaseException:
+            # パイプに残ったデータは再利用できないので破棄する
+            drop_splice_pipe()
+            raise
+        
+        # ボディを読み切ったので接続を再利用可能な状態にする
+        response.length = 0
+        response.close()
+    
+    def send_framing_headers(self, response, compressed=False):
+        """Content-Length/Transfer-Encoding/Connection を決める。再チャンク化する場合は True"""
+        chunked = False
+        content_length = None if response.chunked or compressed else response.getheader('Content-Length')
+        no_body = (self.command == 'HEAD' or response.status in (204, 304)
+                   or 100 <= response.status < 200)
+        if content_length is not None:
+            self.send_header('Content-Length', content_length)
+        elif no_body:
+            pass
+        elif self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            chunked = True
+        else:
+            # HTTP/1.0 クライアントには接続終了でボディの終わりを伝える
+            self.close_connection = True
+        
+        self.send_connection_header()
+        return chunked
+    
+    def send_rate_limited(self, wait):
+        """429 と Retry-After を返す（ボディ付きのリクエストは読まずに接続を閉じる）"""
+        if self.headers.get('Transfer-Encoding') or self.headers.get('Content-Length', '0') != '0':
+            self.close_connection = True
+        body = b"429 Too many requests\n"
+        self.send_response(429)
+        self.send_header('Retry-After', str(math.ceil(wait)))
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_connection_header()
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    def send_connection_header(self):
+        """keep-alive を続けるかどうかを Connection ヘッダーで伝える"""
+        # 待ち行列がある場合は keep-alive 接続でワーカーを占有しない
+        server_busy = getattr(self.server, 'is_busy', None)
+        if (self.close_connection or getattr(self.server, 'draining', False)
+                or (server_busy is not None and server_busy())):
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        elif self.request_version != 'HTTP/1.1':
+            self.send_header('Connection', 'keep-alive')
+    
+    def connection_tokens(self):
+        """Connection ヘッダーのトークン集合"""
+        value = ','.join(self.headers.get_all('Connection') or ())
+        return {token.strip().lower() for token in value.split(',') if token.strip()}
+    
+    def handle_upgrade(self, route, backend_path, host, path):
+        """ハンドシェイクをバックエンドへ転送し、101 ならトンネルに引き渡す"""
+        if not tunnels.reserve():
+            logger.warning(f"Tunnel limit reached, rejecting upgrade for {path}")
+            self.send_error(503, "Too many tunnels")
+            return
+        
+        backend = None
+        permit = None
+        ok = None
+        sock = None
+        handed_over = False
+        try:
+            try:
+                backend = select_backend(route, path, self.headers.get, self.client_address[0])
+            except RouteError as e:
+                self.send_error(e.status, e.message)
+                return
+            permit = backend.begin(route.breaker)
+            if permit is None:
+                backend = None
+                self.send_error(503, "Backend circuit open")
+                return
+            
+            logger.info(f"Upgrading {path} -> ws://{backend}{backend_path}")
+            self.backend = str(backend)
+            try:
+                sock = socket.create_connection((backend.ip, backend.port),
+                                                timeout=route.timeouts.connect)
+                sock.settimeout(route.timeouts.read)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                lines = [f"{self.command} {backend_path} HTTP/1.1"]
+                for header, value in self.headers.items():
+                    if header.lower() not in BACKEND_SKIP_HEADERS:
+                        lines.append(f"{header}: {value}")
+                lines.append(f"Host: {backend.ip}:{backend.port}")
+                lines.append("Connection: Upgrade")
+                lines.append(f"Upgrade: {self.headers['Upgrade']}")
+                for header, value in self.forwarded_headers(host, path):
+                    lines.append(f"{header}: {value}")
+                sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                head, rest = read_http_head(sock)
+                (version, status, *_), response_headers = parse_http_head(head)
+                status = int(status)
+            except (OSError, ValueError) as e:
+                logger.error(f"Upgrade handshake with {backend} failed: {e}")
+                ok = False
+                self.send_error(502, "Backend connection failed")
+                return
+            ok = status < 500
+            
+            self.log_request(status)
+            self.send_response_only(status)
+            for header, value in response_headers:
+                if header.lower() not in ('connection', 'keep-alive', 'upgrade'):
+                    self.send_header(header, value)
+            
+            if status != 101:
+                # アップグレードされなかった場合はレスポンスをそのまま返して閉じる
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                self.relay_handshake_body(sock, rest, header_value(response_headers, 'Content-Length'))
+                return
+            
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Upgrade', header_value(response_headers, 'Upgrade', self.headers['Upgrade']))
+            self.end_headers()
+            
+            # クライアントの接続はトンネルが閉じるまでサーバーに閉じさせない
+            self.close_connection = True
+            self.server.detach_request(self.connection)
+            label = f"{self.client_address[0]} -> {backend}{backend_path}"
+            breaker = route.breaker
+            tunnels.open(self.connection, sock, rest, label,
+                         lambda: backend.end(permit, True, breaker),
+                         upstream=self.take_buffered_input())
+            handed_over = True
+        finally:
+            if not handed_over:
+                tunnels.unreserve()
+                if sock is not None:
+                    sock.close()
+                if backend is not None:
+                    backend.end(permit, ok, route.breaker)
+    
+    def take_buffered_input(self):
+        """rfile に先読みされたままのクライアントのデータを取り出す（ブロックしない）"""
+        self.connection.settimeout(0)
+        try:
+            data = self.rfile.peek()
+        except OSError:
+            return b''
+        finally:
+            self.connection.settimeout(self.timeout)
+        return self.rfile.read(len(data)) if data else b''
+    
+    def relay_handshake_body(self, sock, rest, content_length):
+        """アップグレードされなかったハンドシェイクのボディを中継する"""
+        remaining = int(content_length) if content_length and content_length.isdigit() else None
+        data = rest
+        while True:
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+            if data:
+                self.wfile.write(data)
+            if remaining == 0:
+                break
+            data = sock.recv(TUNNEL_BUFFER_SIZE)
+            if not data:
+                break
+    
+    def lookup_cache(self, route, backend_path, host, path):
+        """キャッシュを確認し、応答済みなら True を返す（X-Cache の値も決める）
+
+        期限切れでも stale-while-revalidate の範囲内なら古い内容で応答して
+        バックグラウンドで再検証する。stale-if-error の範囲内のエントリは
+        バックエンド障害時の代替として self.stale_entry に残す。
+        """
+        if self.command not in ('GET', 'HEAD'):
+            return False
+        
+        mode = request_cache_mode(self.headers)
+        if mode == 'bypass':
+            self.cache_status = 'BYPASS'
+            response_cache.count('bypasses')
+            return False
+        
+        self.cache_key = cache_key(route, backend_path)
+        if mode == 'lookup':
+            # メモリにない場合はディスク層を確認する
+            entry = response_cache.lookup(self.cache_key, self.headers)
+            if entry is None and disk_cache.enabled:
+                entry = disk_cache.lookup(self.cache_key, self.headers)
+            
+            if entry is not None:
+                if entry.is_fresh():
+                    if self.send_cached_response(entry, 'HIT'):
+                        return True
+                else:
+                    stale_while_revalidate, stale_if_error = entry.stale_windows(route.cache)
+                    staleness = entry.staleness()
+                    if staleness <= stale_while_revalidate and self.send_cached_response(entry, 'STALE'):
+                        response_cache.count('stale')
+                        revalidator.submit(route, self.cache_key, backend_path, entry,
+                                           self.headers, self.forwarded_headers(host, path))
+                        return True
+                    if staleness <= stale_if_error:
+                        self.stale_entry = entry
+        self.cache_status = 'MISS'
+        response_cache.count('misses')
+        return False
+    
+    def follow_flight(self, flight):
+        """進行中の同一リクエストの応答を受け取って返す。返せなかった場合は False"""
+        token = flight.join()
+        if token is None:
+            return False
+        try:
+            if not flight.wait_headers(token):
+                return False
+            names, values = flight.vary
+            if vary_values(names, self.headers) != values:
+                return False
+            
+            self.log_request(flight.status)
+            self.send_response_only(flight.status)
+            for header, value in flight.headers:
+                self.send_header(header, value)
+            self.send_header('X-Cache', 'COALESCED')
+            chunked = False
+            if flight.length is not None:
+                self.send_header('Content-Length', str(flight.length))
+            elif flight.status in (204, 304):
+                pass
+            elif self.request_version == 'HTTP/1.1':
+                self.send_header('Transfer-Encoding', 'chunked')
+                chunked = True
+            else:
+                self.close_connection = True
+            self.send_connection_header()
+            self.end_headers()
+            
+            try:
+                while True:
+                    data = flight.read(token)
+                    if data is None:
+                        break
+                    self.bytes_sent += len(data)
+                    if chunked:
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    else:
+                        self.wfile.write(data)
+                if chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+            except FlightAborted as e:
+                logger.warning(f"Coalesced response for {self.path} aborted: {e}")
+                self.close_connection = True
+            return True
+        finally:
+            flight.leave(token)
+    
+    def serve_stale(self, reason):
+        """バックエンド障害時に許容範囲内の古いキャッシュで応答する。応答できたら True"""
+        entry = self.stale_entry
+        if entry is None:
+            return False
+        self.stale_entry = None
+        logger.warning(f"Serving stale cache for {self.path}: {reason}")
+        if not self.send_cached_response(entry, 'STALE'):
+            return False
+        response_cache.count('stale')
+        return True
+    
+    def send_cached_response(self, entry, label):
+        """キャッシュエントリからレスポンスを返す（ディスク層のボディは sendfile で送る）
+
+        ディスク層のボディが消えていた場合は何も送らずに False を返す。
+        """
+        body_file = None
+        if entry.filename:
+            body_file = disk_cache.open_body(entry)
+            if body_file is None:
+                return False
+        
+        # クライアントの条件付きリクエストには 304 で応答する
+        if etag_matches(entry.etag, self.headers.get('If-None-Match')):
+            status = 304
+        else:
+            status = entry.status
+        
+        # メモリ上のエントリは圧縮版を使い回す（ディスク層は sendfile のまま送る）
+        headers, body, length = entry.headers, entry.body, entry.length
+        if (self.compress is not None and body_file is None
+                and self.compress.applies(entry.status, entry.header, length)):
+            headers = gzip_headers(headers)
+            if status != 304:
+                body = compressed_variants.get(entry, self.compress)
+                length = len(body)
+        
+        try:
+            self.log_request(status)
+            self.send_response_only(status)
+            for header, value in headers:
+                self.send_header(header, value)
+            self.send_header('Age', str(entry.age()))
+            self.send_header('X-Cache', label)
+            if status != 304:
+                self.send_header('Content-Length', str(length))
+            self.send_connection_header()
+            self.end_headers()
+            if self.command == 'HEAD' or status == 304 or not length:
+                return True
+            self.bytes_sent += length
+            if body_file is not None:
+                self.connection.sendfile(body_file, 0, length)
+            else:
+                self.wfile.write(body)
+        finally:
+            if body_file is not None:
+                body_file.close()
+        return True
+    
+    def handle_expect_100(self):
+        # 100 Continue はルートとボディ上限を確認してから send_continue() で送る
+        return True
+    
+    def send_continue(self):
+        """Expect: 100-continue のクライアントにボディの送信を促す"""
+        if (self.headers.get('Expect', '').lower() == '100-continue'
+                and self.request_version >= 'HTTP/1.1'):
+            self.send_response_only(100)
+            self.end_headers()
+    
+    def request_body_framing(self, max_body_size):
+        """リクエストボディの (content_length, chunked) を返す"""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return None, True
+        
+        value = self.headers.get('Content-Length')
+        if value is None:
+            # ボディを伴うメソッドには Content-Length: 0 を明示する
+            return (0 if self.command in ['POST', 'PUT', 'PATCH'] else None), False
+        try:
+            content_length = int(value)
+        except ValueError:
+            raise RequestBodyError(400, "Invalid Content-Length")
+        if content_length < 0:
+            raise RequestBodyError(400, "Invalid Content-Length")
+        if max_body_size and content_length > max_body_size:
+            raise RequestBodyError(413, "Request body too large")
+        return content_length, False
+    
+    def iter_request_body(self, content_length, chunked, max_body_size):
+        """クライアントからのボディを REQUEST_CHUNK_SIZE 以下の単位で読み出す"""
+        try:
+            for data in self._iter_request_body(content_length, chunked, max_body_size):
+                self.bytes_received += len(data)
+                yield data
+        except OSError as e:
+            # クライアント側の切断・タイムアウトはバックエンドの障害として扱わない
+            raise RequestBodyError(408, f"Request body not received: {e}")
+    
+    def _iter_request_body(self, content_length, chunked, max_body_size):
+        if not chunked:
+            remaining = content_length
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, REQUEST_CHUNK_SIZE))
+                if not data:
+                    raise RequestBodyError(400, "Incomplete request body")
+                remaining -= len(data)
+                yield data
+            return
+        
+        total = 0
+        while True:
+            line = self.rfile.readline(MAX_CHUNK_LINE)
+            try:
+                size = parse_chunk_size(line)
+            except ValueError:
+                raise RequestBodyError(400, "Invalid chunked encoding")
+            if size == 0:
+                # トレーラーを読み捨てる
+                while self.rfile.readline(MAX_CHUNK_LINE) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            total += size
+            if max_body_size and total > max_body_size:
+                raise RequestBodyError(413, "Request body too large")
+            remaining = size
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, REQUEST_CHUNK_SIZE))
+                if not data:
+                    raise RequestBodyError(400, "Incomplete request body")
+                remaining -= len(data)
+                yield data
+            if self.rfile.read(2) != b'\r\n':
+                raise RequestBodyError(400, "Invalid chunked encoding")
+    
+    def send_to_backend(self, backend, backend_path, host, path,
+                        body_length, body_chunked, max_body_size):
+        """プールの接続でリクエストを送信し (conn, response) を返す
+
+        ボディはクライアントから読みながら逐次バックエンドへ送る。
+        再利用した接続が切断済みだった場合、ボディ送信前で冪等メソッドなら
+        新しい接続で1回だけ再送する。
+        """
+        while True:
+            conn, reused = backend_pool.acquire(backend.ip, backend.port)
+            body_started = False
+            try:
+                # 接続は connect、応答待ちは read（total の残り時間が短ければそちら）で打ち切る
+                read_timeout = self.timeouts.remaining(self.deadline)
+                if conn.sock is None:
+                    conn.timeout = min(self.timeouts.connect, read_timeout)
+                    conn.connect()
+                self.backend_sock = conn.sock
+                conn.sock.settimeout(read_timeout)
+                conn.putrequest(self.command, backend_path, skip_accept_encoding=True)
+                
+                # ヘッダーをコピー（Host とホップバイホップヘッダー以外）
+                for header, value in self.headers.items():
+                    if header.lower() not in BACKEND_SKIP_HEADERS:
+                        conn.putheader(header, value)
+                
+                # プロキシヘッダーを追加
+                for header, value in self.forwarded_headers(host, path):
+                    conn.putheader(header, value)
+                if body_chunked:
+                    conn.putheader('Transfer-Encoding', 'chunked')
+                elif body_length is not None:
+                    conn.putheader('Content-Length', str(body_length))
+                conn.endheaders()
+                
+                # ボディを逐次転送
+                if body_chunked or body_length:
+                    body_started = True
+                    for data in self.iter_request_body(body_length, body_chunked, max_body_size):
+                        if body_chunked:
+                            conn.send(b'%x\r\n%s\r\n' % (len(data), data))
+                        else:
+                            conn.send(data)
+                    if body_chunked:
+                        conn.send(b'0\r\n\r\n')
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                backend_pool.release(conn, False)
+                if reused and not body_started and self.command in IDEMPOTENT_METHODS:
+                    logger.info(f"Retrying on fresh connection to {backend}")
+                    continue
+                raise
+            except BaseException:
+                backend_pool.release(conn, False)
+                raise
+    
+    def forwarded_headers(self, host, path):
+        """バックエンドに付けるプロキシヘッダー"""
+        return [
+            ('X-Forwarded-For', self.client_address[0]),
+            ('X-Forwarded-Host', host),
+            ('X-Forwarded-Proto', 'https'),
+            ('X-Real-IP', self.client_address[0]),
+            ('X-Original-Path', path),
+        ]
     
     def log_message(self, format, *args):
-        """アクセスログ"""
-        logger.info(f"{self.address_string()} - {format % args}")
+        """send_error などの診断メッセージ（結果はアクセスログに残るので debug に留める）"""
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+# ---------------------------------------------------------------------------
+# asyncio エンジン（LPG_PROXY_ENGINE=asyncio で有効）
+# ---------------------------------------------------------------------------
+
+def parse_http_head(data):
+    """ステータス行/リクエスト行とヘッダーのリストに分解する"""
+    lines = data.decode('latin-1').split('\r\n')
+    start = lines[0].split(' ', 2)
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        headers.append((name.strip(), value.strip()))
+    return start, headers
+
+def header_value(headers, name, default=None):
+    """ヘッダーリストから値を取得する（大文字小文字を区別しない）"""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return default
+
+def connection_tokens(headers):
+    """Connection ヘッダーのトークン集合を返す"""
+    value = header_value(headers, 'Connection', '')
+    return {token.strip().lower() for token in value.split(',') if token.strip()}
+
+def requested_upgrade(headers):
+    """Upgrade を要求していればその値を、そうでなければ None を返す"""
+    if 'upgrade' not in connection_tokens(headers):
+        return None
+    return header_value(headers, 'Upgrade') or None
+
+def error_response(status, message, keep_alive=False, headers=()):
+    """エラーレスポンスのバイト列を生成する"""
+    body = f"{status} {message}\n".encode('utf-8')
+    head = (
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+        + ''.join(f"{name}: {value}\r\n" for name, value in headers) +
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    return head.encode('latin-1') + body
+
+async def relay_fixed(reader, writer, length, timeout=None, count=None):
+    """length バイトをそのまま転送する
+
+    timeout は1回の読み込みを待つ秒数、count は転送したボディのバイト数を受け取る関数。
+    """
+    while length > 0:
+        chunk = await asyncio.wait_for(reader.read(min(length, RELAY_CHUNK_SIZE)), timeout)
+        if not chunk:
+            raise asyncio.IncompleteReadError(b'', length)
+        writer.write(chunk)
+        await writer.drain()
+        length -= len(chunk)
+        if count is not None:
+            count(len(chunk))
+
+async def relay_chunked(reader, writer, max_size=None, timeout=None, rechunk=True, count=None):
+    """chunked エンコーディングのボディを検証しながらチャンクごとに転送する
+
+    サイズ行は検証した値で書き直す。rechunk=False ならチャンクの中身だけを書き出す
+    （HTTP/1.0 クライアント向け）。フレームの不正は ValueError を送出する。
+    """
+    total = 0
+    while True:
+        line = await asyncio.wait_for(reader.readuntil(b'\r\n'), timeout)
+        size = parse_chunk_size(line)
+        total += size
+        if max_size and total > max_size:
+            raise RequestBodyError(413, "Request body too large")
+        if rechunk:
+            writer.write(b'%x\r\n' % size)
+        if size == 0:
+            # トレーラーを空行まで転送
+            while True:
+                trailer = await asyncio.wait_for(reader.readuntil(b'\r\n'), timeout)
+                if rechunk:
+                    writer.write(trailer)
+                if trailer == b'\r\n':
+                    break
+            await writer.drain()
+            return
+        await relay_fixed(reader, writer, size, timeout, count)
+        if await asyncio.wait_for(reader.readexactly(2), timeout) != b'\r\n':
+            raise ValueError("Missing CRLF after chunk data")
+        if rechunk:
+            writer.write(b'\r\n')
+
+async def relay_until_eof(reader, writer, chunked, timeout=None, count=None):
+    """接続終了までボディを転送する（chunked=True なら再チャンク化）"""
+    while True:
+        chunk = await asyncio.wait_for(reader.read(RELAY_CHUNK_SIZE), timeout)
+        if not chunk:
+            break
+        if chunked:
+            writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+        else:
+            writer.write(chunk)
+        await writer.drain()
+        if count is not None:
+            count(len(chunk))
+    if chunked:
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+async def relay_tunnel(reader, writer, backend_reader, backend_writer, label, idle_timeout):
+    """101 の後、どちらかが閉じるかアイドルが idle_timeout 秒続くまで双方向に中継する"""
+    started = last_active = time.monotonic()
+    transferred = {'up': 0, 'down': 0}
+
+    async def pipe(src, dst, direction):
+        nonlocal last_active
+        while True:
+            data = await src.read(TUNNEL_BUFFER_SIZE)
+            if not data:
+                return
+            last_active = time.monotonic()
+            transferred[direction] += len(data)
+            dst.write(data)
+            await dst.drain()
+
+    tasks = [asyncio.ensure_future(pipe(reader, backend_writer, 'up')),
+             asyncio.ensure_future(pipe(backend_reader, writer, 'down'))]
+    try:
+        while True:
+            remaining = last_active + idle_timeout - time.monotonic()
+            if remaining <= 0:
+                logger.info(f"Tunnel {label} idle for {idle_timeout}s, closing")
+                break
+            done, _ = await asyncio.wait(tasks, timeout=remaining,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if done:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        tunnels.account(transferred['up'], transferred['down'])
+    logger.info(f"Tunnel {label} closed (up={transferred['up']} down={transferred['down']} "
+                f"duration={time.monotonic() - started:.1f}s)")
+
+class RequestStats:
+    """asyncio エンジンで1リクエスト分のメトリクスとアクセスログの項目を集める"""
+    __slots__ = ('client', 'method', 'path', 'route_labels', 'backend', 'status',
+                 'bytes_received', 'bytes_sent', 'started', 'upstream_started', 'upstream_time')
+
+    def __init__(self, client):
+        self.client = client
+        self.method = None
+        self.path = None
+        self.route_labels = ('', '')
+        self.backend = None
+        self.status = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+        self.upstream_started = None
+        self.upstream_time = None
+
+    def error_response(self, status, message, headers=()):
+        self.status = status
+        return error_response(status, message, headers=headers)
+
+    def received(self, size):
+        self.bytes_received += size
+
+    def sent(self, size):
+        self.bytes_sent += size
+
+    def record(self):
+        now = time.monotonic()
+        if self.upstream_started is not None:
+            self.upstream_time = now - self.upstream_started
+        metrics.observe_request(*self.route_labels, self.status, now - self.started,
+                                self.bytes_received, self.bytes_sent)
+        access_log.log({
+            'time': time.time(),
+            'client': self.client,
+            'method': self.method,
+            'path': self.path,
+            'host': self.route_labels[0],
+            'route': self.route_labels[1],
+            'backend': self.backend,
+            'status': self.status,
+            'bytes_in': self.bytes_received,
+            'bytes_out': self.bytes_sent,
+            'cache': None,
+            'upstream_time': None if self.upstream_time is None else round(self.upstream_time, 4),
+            'total_time': round(now - self.started, 4),
+        })
+
+class AsyncProxyEngine:
+    """ノンブロッキングストリームで動作するプロキシエンジン
+
+    ルーティングとパス書き換えは LPGProxyHandler と同じ resolve_route を使用し、
+    クライアント・バックエンド双方を asyncio ストリームで中継する。
+    クライアント接続は HTTP/1.1 keep-alive を維持し、Upgrade は 101 の後にトンネルとして中継する。
+    """
+
+    request_queue_size = 1024
+
+    def __init__(self, host, port, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT, listen_socket=None,
+                 lifecycle=None):
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.listen_socket = listen_socket
+        self.lifecycle = lifecycle
+        self.draining = False
+
+    async def serve(self):
+        if self.listen_socket is not None:
+            server = await asyncio.start_server(self.handle_client, sock=self.listen_socket,
+                                                limit=MAX_HEADER_BYTES)
+        else:
+            server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                limit=MAX_HEADER_BYTES, backlog=self.request_queue_size)
+        if self.lifecycle is None:
+            async with server:
+                await server.serve_forever()
+            return
+        
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        self.lifecycle.stop_accepting = lambda: loop.call_soon_threadsafe(stopping.set)
+        loop.add_signal_handler(signal.SIGHUP, self.lifecycle.request)
+        self.lifecycle.ready()
+        await stopping.wait()
+        
+        # 受け付けを止め、処理中の接続が終わるか期限が来るまで待つ。
+        # 受け付け済みでまだ handle_client に渡っていない接続は close() 後だと
+        # 取りこぼされるので、先に accept だけ止めて一巡させてから閉じる
+        self.draining = True
+        deadline = time.monotonic() + self.lifecycle.drain_timeout
+        for sock in server.sockets:
+            loop.remove_reader(sock.fileno())
+        await asyncio.sleep(0.2)
+        server.close()
+        while active_connections() and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        self.lifecycle.finish(active_connections())
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    @staticmethod
+    def warn_unsupported(snapshot):
+        """このエンジンでは効かない設定（キャッシュ・集約・圧縮・再試行）を警告する"""
+        if 'retries' in snapshot.data.get('options', {}):
+            logger.warning("options.retries is ignored by the asyncio engine")
+        for route in snapshot.routes.routes:
+            ignored = [name for name, enabled in (
+                ('cache', route.cache is not None),
+                ('coalesce', route.coalesce),
+                ('compress', route.compress is not None),
+                ('retries', 'retries' in route.rule),
+            ) if enabled]
+            if ignored:
+                logger.warning(f"Route {route.host}{route.prefix}: {', '.join(ignored)} "
+                               f"ignored by the asyncio engine")
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('-', 0)
+        metrics.inc('lpg_connections_opened_total')
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                  self.keepalive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(error_response(431, "Request header fields too large"))
+                    break
+                stats = RequestStats(peer[0])
+                try:
+                    keep_alive = await self.handle_request(head, reader, writer, peer[0], stats)
+                finally:
+                    stats.record()
+                if not keep_alive or self.draining:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except Exception as e:
+            logger.error(f"Proxy error: {e}")
+        finally:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+            metrics.inc('lpg_connections_closed_total')
+
+    async def handle_request(self, head, reader, writer, peer, stats):
+        """1リクエストを処理する。接続を維持できる場合は True を返す"""
+        try:
+            (method, path, version), headers = parse_http_head(head)
+        except ValueError:
+            writer.write(stats.error_response(400, "Bad request"))
+            return False
+        stats.method = method
+        stats.path = path
+        
+        tokens = connection_tokens(headers)
+        if self.draining:
+            keep_alive = False
+        elif version == 'HTTP/1.1':
+            keep_alive = 'close' not in tokens
+        else:
+            keep_alive = 'keep-alive' in tokens
+        
+        host = header_value(headers, 'Host', '').split(':')[0]
+        header = lambda name: header_value(headers, name)
+        ip = client_ip(header, peer)
+        snapshot = load_config()
+        wait = check_rate_limits(snapshot, None, ip)
+        if wait:
+            writer.write(stats.error_response(429, "Too many requests",
+                                              headers=[('Retry-After', math.ceil(wait))]))
+            return False
+        try:
+            route, backend_path = resolve_route(snapshot, host, path)
+            stats.route_labels = (route.host, route.prefix)
+            if route.allow is not None and not route.allow.allows(ip):
+                logger.debug(f"Denied {ip} for {host}{route.prefix} by ips")
+                writer.write(stats.error_response(403, "Forbidden"))
+                return False
+            wait = check_rate_limits(snapshot, route, ip)
+            if wait:
+                writer.write(stats.error_response(429, "Too many requests",
+                                                  headers=[('Retry-After', math.ceil(wait))]))
+                return False
+            backend = select_backend(route, path, header, peer)
+        except RouteError as e:
+            writer.write(stats.error_response(e.status, e.message))
+            return False
+        
+        # ボディ上限の確認（超過はバックエンドに接続する前に 413）
+        try:
+            content_length = int(header_value(headers, 'Content-Length', 0) or 0)
+        except ValueError:
+            writer.write(stats.error_response(400, "Invalid Content-Length"))
+            return False
+        if route.max_body_size and content_length > route.max_body_size:
+            writer.write(stats.error_response(413, "Request body too large"))
+            return False
+        if version == 'HTTP/1.1' and header_value(headers, 'Expect', '').lower() == '100-continue':
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        
+        logger.debug(f"Proxying {method} {path} -> http://{backend}{backend_path}")
+        stats.backend = str(backend)
+        
+        # Upgrade（WebSocket など）は 101 の後にトンネルとして中継する
+        upgrade = requested_upgrade(headers)
+        if upgrade and not tunnels.reserve():
+            logger.warning(f"Tunnel limit reached, rejecting upgrade for {path}")
+            writer.write(stats.error_response(503, "Too many tunnels"))
+            return False
+        
+        permit = backend.begin(route.breaker)
+        if permit is None:
+            if upgrade:
+                tunnels.unreserve()
+            writer.write(stats.error_response(503, "Backend circuit open"))
+            return False
+        
+        ok = None
+        stats.upstream_started = time.monotonic()
+        try:
+            keep_alive, ok = await self.proxy(method, version, path, backend, backend_path, headers,
+                                              host, peer, keep_alive, reader, writer,
+                                              route.max_body_size, route.timeouts, stats)
+            return keep_alive
+        finally:
+            if upgrade:
+                tunnels.unreserve()
+            backend.end(permit, ok, route.breaker)
+            stats.upstream_time = time.monotonic() - stats.upstream_started
+            stats.upstream_started = None
+
+    async def proxy(self, method, version, path, backend, backend_path, headers, host, client_ip,
+                    keep_alive, reader, writer, max_body_size, timeouts, stats):
+        """バックエンドに接続してリクエストを中継する。(keep_alive, バックエンドの成否) を返す
+
+        timeouts.total は接続からレスポンスの転送完了までの上限（101 後のトンネルは対象外）。
+        """
+        deadline = timeouts.deadline()
+        if requested_upgrade(headers):
+            deadline = None
+        try:
+            backend_reader, backend_writer = await asyncio.wait_for(
+                asyncio.open_connection(backend.ip, backend.port, limit=MAX_HEADER_BYTES),
+                timeouts.connect if deadline is None else min(timeouts.connect, timeouts.total))
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.error(f"Backend connection error: {e}")
+            writer.write(stats.error_response(502, "Backend connection failed"))
+            return False, False
+        
+        # forward() はレスポンスヘッダーを書き出す直前に stats.status を設定する
+        try:
+            keep_alive, status = await asyncio.wait_for(
+                self.forward(method, version, path, backend_path, headers, host, client_ip,
+                             keep_alive, reader, writer, backend_reader, backend_writer,
+                             str(backend), max_body_size, timeouts.read, stats),
+                None if deadline is None else max(deadline - time.monotonic(), 0))
+            return keep_alive, status < 500
+        except RequestBodyError as e:
+            logger.warning(f"Request body rejected: {e.status} {e.message}")
+            writer.write(stats.error_response(e.status, e.message))
+            return False, None
+        except asyncio.TimeoutError:
+            logger.error(f"Backend timeout: {backend}")
+            if stats.status is not None:
+                return False, None
+            writer.write(stats.error_response(504, "Gateway timeout"))
+            return False, False
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError) as e:
+            # ヘッダー送信後はクライアント側の切断もありうるので接続を閉じるだけにする
+            if stats.status is not None:
+                return False, None
+            logger.error(f"Backend response error: {backend}: {e!r}")
+            writer.write(stats.error_response(502, "Bad Gateway"))
+            return False, False
+        finally:
+            backend_writer.close()
+
+    async def forward(self, method, version, path, backend_path, headers, host, client_ip,
+                      keep_alive, reader, writer, backend_reader, backend_writer, backend_host,
+                      max_body_size, read_timeout, stats):
+        """リクエストを転送し、レスポンスをクライアントへ中継する。(keep_alive, status) を返す"""
+        # リクエストヘッダーを構築（Host とホップバイホップヘッダー以外をコピー）
+        request_chunked = 'chunked' in header_value(headers, 'Transfer-Encoding', '').lower()
+        upgrade = requested_upgrade(headers)
+        hop = HOP_BY_HOP_HEADERS | connection_tokens(headers)
+        lines = [f"{method} {backend_path} HTTP/1.1", f"Host: {backend_host}"]
+        for name, value in headers:
+            lower = name.lower()
+            if lower in hop or lower in PROXY_HEADERS or lower in ('host', 'expect'):
+                continue
+            # Transfer-Encoding がある場合の Content-Length は無視して送らない（RFC 9112 6.1）
+            if lower == 'content-length' and request_chunked:
+                continue
+            lines.append(f"{name}: {value}")
+        
+        # プロキシヘッダーを追加
+        lines.append(f"X-Forwarded-For: {client_ip}")
+        lines.append(f"X-Forwarded-Host: {host}")
+        lines.append("X-Forwarded-Proto: https")
+        lines.append(f"X-Real-IP: {client_ip}")
+        lines.append(f"X-Original-Path: {path}")
+        if request_chunked:
+            lines.append("Transfer-Encoding: chunked")
+        if upgrade:
+            lines.append(f"Upgrade: {upgrade}")
+            lines.append("Connection: Upgrade")
+        else:
+            lines.append("Connection: close")
+        backend_writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        
+        # リクエストボディを転送（クライアント側の不備はバックエンドの失敗として数えない）
+        try:
+            if request_chunked:
+                await relay_chunked(reader, backend_writer, max_body_size, read_timeout,
+                                    count=stats.received)
+            else:
+                content_length = int(header_value(headers, 'Content-Length', 0) or 0)
+                await relay_fixed(reader, backend_writer, content_length, read_timeout,
+                                  count=stats.received)
+        except asyncio.IncompleteReadError:
+            raise RequestBodyError(400, "Incomplete request body")
+        except asyncio.TimeoutError:
+            raise RequestBodyError(408, "Request body timeout")
+        except (ValueError, asyncio.LimitOverrunError):
+            raise RequestBodyError(400, "Invalid chunked encoding")
+        await backend_writer.drain()
+        
+        # レスポンスヘッダーを受信（100 Continue などの中間応答は読み飛ばす）
+        while True:
+            response_head = await asyncio.wait_for(
+                backend_reader.readuntil(b'\r\n\r\n'), read_timeout)
+            (_, status, *reason), response_headers = parse_http_head(response_head)
+            status = int(status)
+            if status >= 200 or (status == 101 and upgrade):
+                break
+        
+        if status == 101:
+            # プロトコル切り替え後は HTTP として解釈せずにそのまま中継する
+            response_hop = HOP_BY_HOP_HEADERS | connection_tokens(response_headers)
+            out = [f"HTTP/1.1 101 {reason[0] if reason else HTTPStatus(101).phrase}"]
+            for name, value in response_headers:
+                if name.lower() not in response_hop:
+                    out.append(f"{name}: {value}")
+            out.append(f"Upgrade: {header_value(response_headers, 'Upgrade', upgrade)}")
+            out.append("Connection: Upgrade")
+            stats.status = status
+            writer.write(('\r\n'.join(out) + '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+            logger.info(f"Upgrading {path} -> ws://{backend_host}{backend_path}")
+            await relay_tunnel(reader, writer, backend_reader, backend_writer,
+                               f"{client_ip} -> {backend_host}{backend_path}", tunnels.idle_timeout)
+            return False, status
+        
+        # レスポンスのフレーミングを決定
+        response_hop = HOP_BY_HOP_HEADERS | connection_tokens(response_headers)
+        response_chunked = 'chunked' in header_value(response_headers, 'Transfer-Encoding', '').lower()
+        if response_chunked:
+            response_hop |= {'content-length'}
+        content_length = header_value(response_headers, 'Content-Length')
+        no_body = method == 'HEAD' or status in (204, 304)
+        # HTTP/1.0 クライアントには chunked を使わず、接続終了でボディの終わりを伝える
+        rechunk = version == 'HTTP/1.1'
+        
+        out = [f"HTTP/1.1 {status} {reason[0] if reason else HTTPStatus(status).phrase}"]
+        for name, value in response_headers:
+            if name.lower() not in response_hop:
+                out.append(f"{name}: {value}")
+        if response_chunked:
+            content_length = None
+        if no_body or content_length is not None:
+            pass
+        elif rechunk:
+            # 長さ不明のボディは再チャンク化して keep-alive を維持する
+            out.append("Transfer-Encoding: chunked")
+        else:
+            keep_alive = False
+        out.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        stats.status = status
+        writer.write(('\r\n'.join(out) + '\r\n\r\n').encode('latin-1'))
+        
+        # ボディを転送
+        if no_body:
+            pass
+        elif response_chunked:
+            await relay_chunked(backend_reader, writer, timeout=read_timeout, rechunk=rechunk,
+                                count=stats.sent)
+        elif content_length is not None:
+            await relay_fixed(backend_reader, writer, int(content_length), read_timeout,
+                              count=stats.sent)
+        else:
+            await relay_until_eof(backend_reader, writer, chunked=rechunk, timeout=read_timeout,
+                                  count=stats.sent)
+        await writer.drain()
+        return keep_alive, status
+
+# ---------------------------------------------------------------------------
+# 管理用エンドポイント（127.0.0.1 のみ）
+# ---------------------------------------------------------------------------
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """lpg_admin.py などローカルのツールに内部状態を提供する"""
+
+    def do_GET(self):
+        if self.path == '/__lpg/stats':
+            self.send_json({
+                'backend_pool': backend_pool.stats(),
+                'backends': backends.stats(),
+                'tunnels': tunnels.stats(),
+                'retry_budget': retry_budget.stats(),
+                'access_log': access_log.stats(),
+                'rate_limit': rate_limiter.stats(),
+            })
+        elif self.path == '/__lpg/health':
+            self.send_json(backends.health())
+        elif self.path == '/__lpg/metrics':
+            body = metrics.render(proxy_gauges()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/__lpg/cache':
+            self.send_json(dict(response_cache.stats(), disk=disk_cache.stats(),
+                                coalesce=flights.stats(), gzip=compressed_variants.stats()))
+        else:
+            self.send_error(404, "Not found")
+
+    def do_POST(self):
+        if self.path == '/__lpg/cache/clear':
+            response_cache.clear()
+            disk_cache.clear()
+            compressed_variants.clear()
+            self.send_json({'status': 'success'})
+        else:
+            self.send_error(404, "Not found")
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"control: {format % args}")
+
+def start_control_server(port, handler_class=ControlHandler):
+    """管理用エンドポイントをバックグラウンドで起動する
+
+    リロード中は旧プロセスがポートを手放すまで CONTROL_BIND_TIMEOUT 秒まで待つ。
+    """
+    deadline = time.monotonic() + CONTROL_BIND_TIMEOUT
+    while True:
+        try:
+            server = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+            break
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='lpg-control', daemon=True).start()
+    logger.info(f'LPG Proxy control endpoint on 127.0.0.1:{port}')
+    return server
+
+# ---------------------------------------------------------------------------
+# グレースフルリロード（SIGHUP）
+# ---------------------------------------------------------------------------
+
+def sd_notify(message):
+    """systemd（Type=notify）に状態を通知する。NOTIFY_SOCKET がなければ何もしない"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode('utf-8'), address)
+    except OSError as e:
+        logger.warning(f"sd_notify failed: {e}")
+
+def create_listen_socket(host, port, backlog):
+    """待ち受けソケットを作る（子プロセスには spawn_proxy で引き継ぐ）"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def inherited_listen_socket():
+    """親プロセスや旧プロセスから LPG_PROXY_LISTEN_FD で引き継いだソケット（なければ None）"""
+    fd = os.environ.pop('LPG_PROXY_LISTEN_FD', None)
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+def spawn_proxy(listen_socket, env):
+    """listen_socket を引き継いだ lpg-proxy.py を起動し、待ち受けを始めるまで待つ
+
+    起動した Popen と、RELOAD_READY_TIMEOUT 秒以内に準備完了を通知したかを返す。
+    """
+    ready_r, ready_w = os.pipe()
+    env = dict(env, LPG_PROXY_LISTEN_FD=str(listen_socket.fileno()), LPG_PROXY_READY_FD=str(ready_w))
+    try:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env,
+                                pass_fds=(listen_socket.fileno(), ready_w))
+    finally:
+        os.close(ready_w)
+    try:
+        readable, _, _ = select.select([ready_r], [], [], RELOAD_READY_TIMEOUT)
+        ready = bool(readable) and os.read(ready_r, 1) == b'1'
+    finally:
+        os.close(ready_r)
+    return proc, ready
+
+class ProxyLifecycle:
+    """1つのプロキシプロセスの準備完了通知と SIGHUP によるグレースフルリロード
+
+    単独プロセスでは待ち受けソケットを引き継いだ後継を自分で起動し、その準備完了を
+    確認してから受け付けを止める（後継が起動できなければそのまま動き続ける）。
+    ワーカーでは後継は親が起動するので、管理用ポートを手放して受け付けを止めるだけにする。
+    受け付けを止めた後は処理中の接続を drain_timeout 秒まで待ってから終了する。
+    """
+
+    def __init__(self, listen_socket, control_port, drain_timeout, handoff):
+        self.listen_socket = listen_socket
+        self.control_port = control_port
+        self.drain_timeout = drain_timeout
+        self.handoff = handoff
+        self.control_server = None
+        self.stop_accepting = None
+        self.reloading = False
+
+    def start_control(self):
+        self.control_server = start_control_server(self.control_port)
+
+    def stop_control(self):
+        if self.control_server is not None:
+            self.control_server.shutdown()
+            self.control_server.server_close()
+            self.control_server = None
+
+    def ready(self):
+        """待ち受けの準備ができたことを起動元（旧プロセス・親・systemd）に知らせる"""
+        fd = os.environ.pop('LPG_PROXY_READY_FD', None)
+        if fd is not None:
+            os.write(int(fd), b'1')
+            os.close(int(fd))
+        if self.handoff:
+            sd_notify(f"READY=1\nMAINPID={os.getpid()}")
+
+    def request(self, signum=None, frame=None):
+        """SIGHUP ハンドラー（処理はシグナルハンドラーの外のスレッドで行う）"""
+        if not self.reloading:
+            self.reloading = True
+            threading.Thread(target=self.reload, name='lpg-reload', daemon=True).start()
+
+    def reload(self):
+        logger.info('Reload requested')
+        # 後継が同じ管理用ポートで待ち受けられるよう先に手放す
+        self.stop_control()
+        if self.handoff:
+            sd_notify('RELOADING=1')
+            # 後継が読み込む前に未保存のキャッシュ index を書き出しておく
+            disk_cache.flush()
+            env = dict(os.environ)
+            successor, ready = spawn_proxy(self.listen_socket, env)
+            if not ready:
+                logger.error(f"Successor (pid {successor.pid}) did not become ready, keeping this process")
+                successor.kill()
+                successor.wait()
+                self.start_control()
+                sd_notify('READY=1')
+                self.reloading = False
+                return
+            logger.info(f"Handed the listening socket to pid {successor.pid}, draining")
+        disk_cache.release()
+        self.stop_accepting()
+
+    def drain(self, pending):
+        """pending() が 0 になるか drain_timeout が過ぎるまで待つ"""
+        deadline = time.monotonic() + self.drain_timeout
+        while pending() and time.monotonic() < deadline:
+            time.sleep(0.2)
+        self.finish(pending())
+
+    def finish(self, left):
+        if left:
+            logger.warning(f"Drain timeout, closing {left} remaining connections")
+        access_log.flush(2)
+        disk_cache.flush()
+        logger.info('Drained, exiting')
+
+# ---------------------------------------------------------------------------
+# マルチプロセスモード（1つの待ち受けソケットを共有するワーカー群）
+# ---------------------------------------------------------------------------
+
+def merge_metrics(texts):
+    """各ワーカーの /__lpg/metrics を同じ系列ごとに合算する"""
+    order = []
+    values = {}
+    for text in texts:
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('#'):
+                if line not in values:
+                    order.append(line)
+                    values[line] = None
+                continue
+            series, _, value = line.rpartition(' ')
+            if series not in values:
+                order.append(series)
+                values[series] = 0
+            values[series] += float(value)
+    lines = []
+    for key in order:
+        value = values[key]
+        if value is None:
+            lines.append(key)
+        else:
+            lines.append(f"{key} {int(value) if value.is_integer() else round(value, 6)}")
+    return '\n'.join(lines) + '\n'
+
+def merge_stats(a, b):
+    """JSON の統計値を数値は合算、それ以外は先の値を残してマージする"""
+    if isinstance(a, dict) and isinstance(b, dict):
+        merged = dict(a)
+        for key, value in b.items():
+            merged[key] = merge_stats(a[key], value) if key in a else value
+        return merged
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+        return a + b
+    return a
+
+class WorkerSupervisor:
+    """ワーカープロセスを起動・監視し、管理用エンドポイントで値を合算して返す
+
+    各ワーカーは LPG_PROXY_WORKER=<番号> を付けて起動した lpg-proxy.py 自身で、
+    親が作った1つの待ち受けソケットを全員が引き継いで accept する。
+    接続は稼働中のワーカーのどれかが受け取るので、落ちたワーカーや再起動待ちの
+    ワーカーの分の接続が取り残されることはない。
+    終了したワーカーは起動し直す（起動直後に落ちた場合は WORKER_RESTART_DELAY 秒待つ）。
+    SIGHUP では番号順に旧ワーカーを排出（drain）に回して新しいワーカーと入れ替える。
+    """
+
+    def __init__(self, count, host, port, backlog, control_port):
+        self.count = count
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.control_port = control_port
+        self.listen_socket = None
+        self.workers = {}
+        self.draining = []
+        self.started = {}
+        self.restart_at = {}
+        self.restarts = 0
+        self.stopping = False
+        self.reload_requested = False
+
+    def worker_port(self, index):
+        return self.control_port + 1 + index
+
+    def spawn(self, index):
+        """ワーカーを起動し、待ち受けを始めたかを返す"""
+        env = dict(os.environ, LPG_PROXY_WORKER=str(index))
+        env.pop('NOTIFY_SOCKET', None)
+        proc, ready = spawn_proxy(self.listen_socket, env)
+        self.workers[index] = proc
+        self.started[index] = time.monotonic()
+        logger.info(f"Started worker {index} (pid {proc.pid})")
+        return ready
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        SupervisorControlHandler.supervisor = self
+        start_control_server(self.control_port, SupervisorControlHandler)
+        self.listen_socket = create_listen_socket(self.host, self.port, self.backlog)
+        for index in range(self.count):
+            self.spawn(index)
+        sd_notify('READY=1')
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            time.sleep(0.5)
+        self.terminate()
+
+    def request_reload(self, signum=None, frame=None):
+        self.reload_requested = True
+
+    def reload(self):
+        """ワーカーを1つずつ新しいプロセスに入れ替える（旧ワーカーは処理中の接続を終えてから終了する）"""
+        sd_notify('RELOADING=1')
+        for index in range(self.count):
+            old = self.workers.get(index)
+            if old is not None and old.poll() is None:
+                old.send_signal(signal.SIGHUP)
+                self.draining.append(old)
+            self.restart_at.pop(index, None)
+            if not self.spawn(index):
+                # 残りの番号は旧ワーカーのまま。落ちた番号は reap() が起動し直す
+                logger.error(f"Worker {index} did not become ready, aborting reload")
+                self.workers[index].kill()
+                break
+        else:
+            logger.info(f"Reloaded {self.count} workers")
+        sd_notify('READY=1')
+
+    def reap(self):
+        """終了したワーカーを起動し直す（排出中の旧ワーカーは回収するだけ）"""
+        self.draining = [proc for proc in self.draining if proc.poll() is None]
+        now = time.monotonic()
+        for index, proc in list(self.workers.items()):
+            if proc.poll() is None:
+                continue
+            if index not in self.restart_at:
+                logger.error(f"Worker {index} (pid {proc.pid}) exited with {proc.returncode}")
+                quick = now - self.started[index] < WORKER_MIN_UPTIME
+                self.restart_at[index] = now + (WORKER_RESTART_DELAY if quick else 0)
+            if now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self.restarts += 1
+                self.spawn(index)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def terminate(self):
+        logger.info('Shutting down LPG Proxy workers...')
+        procs = list(self.workers.values()) + self.draining
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for proc in procs:
+            try:
+                proc.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    def fetch(self, path, method='GET'):
+        """稼働中の各ワーカーの管理用エンドポイントに問い合わせ、(番号, 応答本文) を返す"""
+        results = []
+        for index, proc in sorted(self.workers.items()):
+            if proc.poll() is not None:
+                continue
+            request = urllib.request.Request(f"http://127.0.0.1:{self.worker_port(index)}{path}",
+                                             method=method)
+            try:
+                with urllib.request.urlopen(request, timeout=2) as response:
+                    results.append((index, response.read()))
+            except OSError as e:
+                logger.warning(f"Worker {index} control endpoint unavailable: {e}")
+        return results
+
+    def stats(self):
+        return {
+            'workers': self.count,
+            'alive': sum(1 for proc in self.workers.values() if proc.poll() is None),
+            'draining': sum(1 for proc in self.draining if proc.poll() is None),
+            'restarts': self.restarts,
+            'pids': {index: proc.pid for index, proc in self.workers.items()},
+        }
+
+class SupervisorControlHandler(ControlHandler):
+    """マルチプロセスモードの親プロセスの管理用エンドポイント（各ワーカーの値を合算する）"""
+
+    supervisor = None
+
+    def do_GET(self):
+        supervisor = self.supervisor
+        if self.path == '/__lpg/metrics':
+            texts = [body.decode('utf-8') for _, body in supervisor.fetch(self.path)]
+            stats = supervisor.stats()
+            texts.append(
+                "# HELP lpg_workers Worker processes by state\n"
+                "# TYPE lpg_workers gauge\n"
+                f'lpg_workers{{state="configured"}} {stats["workers"]}\n'
+                f'lpg_workers{{state="alive"}} {stats["alive"]}\n'
+                "# HELP lpg_worker_restarts_total Worker processes restarted by the supervisor\n"
+                "# TYPE lpg_worker_restarts_total counter\n"
+                f"lpg_worker_restarts_total {stats['restarts']}\n")
+            body = merge_metrics(texts).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/__lpg/stats':
+            workers = {index: json.loads(body) for index, body in supervisor.fetch(self.path)}
+            self.send_json({'supervisor': supervisor.stats(), 'workers': workers})
+        elif self.path == '/__lpg/health':
+            # ヘルスチェックは各ワーカーが同じ対象に行うので最初に応答したものを返す
+            results = supervisor.fetch(self.path)
+            self.send_json(json.loads(results[0][1]) if results else {}, 200 if results else 503)
+        elif self.path == '/__lpg/cache':
+            merged = {}
+            for _, body in supervisor.fetch(self.path):
+                merged = merge_stats(merged, json.loads(body)) if merged else json.loads(body)
+            self.send_json(merged)
+        else:
+            self.send_error(404, "Not found")
+
+    def do_POST(self):
+        if self.path == '/__lpg/cache/clear':
+            results = self.supervisor.fetch(self.path, method='POST')
+            self.send_json({'status': 'success', 'workers': len(results)})
+        else:
+            self.send_error(404, "Not found")
 
 if __name__ == '__main__':
     # 環境変数から設定を読み込み（デフォルトは127.0.0.1:8080）
+    # LPG_PROXY_ENGINE: threaded（デフォルト）または asyncio
     host = os.environ.get('LPG_PROXY_HOST', '127.0.0.1')
     port = int(os.environ.get('LPG_PROXY_PORT', '8080'))
     
-    server = HTTPServer((host, port), LPGProxyHandler)
-    logger.info(f'LPG Proxy listening on {host}:{port}')
+    if sys.argv[1:] == ['--check']:
+        # 設定ファイルの検査だけ行う（lpg_admin のデプロイ前チェック用）
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                ConfigSnapshot(json.load(f), None)
+        except Exception as e:
+            print(f"{CONFIG_FILE}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"{CONFIG_FILE}: ok")
+        sys.exit(0)
+    
+    engine = os.environ.get('LPG_PROXY_ENGINE', 'threaded')
+    backlog = (AsyncProxyEngine if engine == 'asyncio' else LPGProxyServer).request_queue_size
+    options = load_options()
     
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        logger.info('Shutting down LPG Proxy...')
-        server.shutdown()
+    # LPG_PROXY_WORKERS（なければ options.workers）が 2 以上なら親プロセスはワーカーの監視に専念する
+    worker_count = int(os.environ.get('LPG_PROXY_WORKERS') or options.get('workers', 1))
+    worker_index = os.environ.get('LPG_PROXY_WORKER')
+    control_port = int(options.get('control_port', DEFAULT_CONTROL_PORT))
+    if worker_count > 1 and worker_index is None:
+        logger.info(f'LPG Proxy supervisor starting {worker_count} workers on {host}:{port}')
+        WorkerSupervisor(worker_count, host, port, backlog, control_port).run()
+        sys.exit(0)
+    
+    cache_dir = options.get('cache_dir', DEFAULT_CACHE_DIR)
+    cache_disk_size = int(options.get('cache_disk_size', DEFAULT_CACHE_DISK_SIZE))
+    if worker_index is not None:
+        # ワーカーごとに管理用ポートとディスクキャッシュ（容量は等分）を分ける
+        worker_index = int(worker_index)
+        control_port += 1 + worker_index
+        cache_dir = os.path.join(cache_dir, f'worker-{worker_index}')
+        cache_disk_size //= worker_count
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(
+                f'%(asctime)s - %(levelname)s - [worker {worker_index}] %(message)s'))
+    
+    backend_pool.max_idle = int(options.get('backend_pool_max_idle', DEFAULT_POOL_MAX_IDLE))
+    backend_pool.max_total = int(options.get('backend_pool_max_total', DEFAULT_POOL_MAX_TOTAL))
+    backend_pool.idle_timeout = float(options.get('backend_pool_idle_timeout', DEFAULT_POOL_IDLE_TIMEOUT))
+    response_cache.max_size = int(options.get('cache_memory_size', DEFAULT_CACHE_MEMORY_SIZE))
+    compressed_variants.max_size = int(options.get('compress_cache_size', DEFAULT_COMPRESS_CACHE_SIZE))
+    budget = options.get('retry_budget', {})
+    retry_budget.configure(budget.get('ratio', DEFAULT_RETRY_BUDGET_RATIO),
+                           budget.get('min_per_second', DEFAULT_RETRY_BUDGET_MIN_PER_SECOND))
+    tunnels.max_tunnels = int(options.get('max_tunnels', DEFAULT_MAX_TUNNELS))
+    tunnels.idle_timeout = float(options.get('tunnel_idle_timeout', DEFAULT_TUNNEL_IDLE_TIMEOUT))
+    disk_cache.open(cache_dir, cache_disk_size)
+    rate_limiter.max_entries = int(options.get('rate_limit', {}).get('table_size',
+                                                                     DEFAULT_RATE_LIMIT_TABLE_SIZE))
+    access_log.configure(options.get('access_log', {}))
+    access_log.start()
+    
+    # SIGHUP でグレースフルリロードする（単独プロセスなら後継を起動してソケットを引き継ぐ）
+    listen_socket = inherited_listen_socket() or create_listen_socket(host, port, backlog)
+    lifecycle = ProxyLifecycle(listen_socket, control_port,
+                               float(options.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT)),
+                               handoff=worker_index is None)
+    lifecycle.start_control()
+    
+    # 設定の再読み込みに合わせてヘルスチェック対象を更新する
+    config_store.subscribe(health_monitor.sync)
+    health_monitor.sync(load_config())
+    
+    keepalive_timeout = int(options.get('keepalive_timeout', DEFAULT_KEEPALIVE_TIMEOUT))
+    
+    if engine == 'asyncio':
+        config_store.subscribe(AsyncProxyEngine.warn_unsupported)
+        AsyncProxyEngine.warn_unsupported(load_config())
+        logger.info(f'LPG Proxy (asyncio) listening on {host}:{port}')
+        try:
+            AsyncProxyEngine(host, port, keepalive_timeout=keepalive_timeout,
+                             listen_socket=listen_socket, lifecycle=lifecycle).run()
+        except KeyboardInterrupt:
+            logger.info('Shutting down LPG Proxy...')
+    else:
+        workers = int(options.get('proxy_workers', DEFAULT_PROXY_WORKERS))
+        queue_size = int(options.get('proxy_queue_size', DEFAULT_PROXY_QUEUE_SIZE))
+        retry_after = int(options.get('proxy_retry_after', DEFAULT_PROXY_RETRY_AFTER))
+        LPGProxyHandler.timeout = keepalive_timeout
+        
+        server = LPGProxyServer((host, port), LPGProxyHandler,
+                                workers=workers, queue_size=queue_size, retry_after=retry_after,
+                                listen_socket=listen_socket)
+        logger.info(f'LPG Proxy listening on {host}:{port} (workers={workers}, queue={queue_size})')
+        lifecycle.stop_accepting = server.begin_drain
+        signal.signal(signal.SIGHUP, lifecycle.request)
+        lifecycle.ready()
+        
+        try:
+            server.serve_forever()
+            lifecycle.drain(server.pending)
+        except KeyboardInterrupt:
+            logger.info('Shutting down LPG Proxy...')
+        server.server_close()
+    disk_cache.flush()
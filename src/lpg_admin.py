@@ -17,6 +17,7 @@ __version__ = "1.1"
 __date__ = "2025-08-06"
 
 import os
+import sys
 import json
 import hashlib
 import secrets
@@ -32,6 +33,7 @@ import threading
 import time
 import logging
 import subprocess
+import urllib.request
 
 # サーバー起動時刻を記録
 START_TIME = datetime.now()
@@ -177,6 +179,32 @@ def get_network_metrics():
         }
     }
 
+def fetch_proxy_status(path, timeout=2, method='GET'):
+    """LPGプロキシの管理用エンドポイント(127.0.0.1のみ)からJSONを取得"""
+    port = load_config().get('options', {}).get('control_port', 9180)
+    try:
+        req = urllib.request.Request(f'http://127.0.0.1:{port}{path}', method=method)
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return json.load(response)
+    except Exception as e:
+        print(f"Error fetching proxy status {path}: {e}")
+        return None
+
+def get_backend_alive(health, ip, ports=None):
+    """プロキシのヘルスチェック結果からデバイスの死活を判定(監視対象外ならNone)"""
+    ports = {str(p) for p in (ports or [])}
+    results = []
+    for address, status in (health or {}).items():
+        backend_ip, _, backend_port = address.rpartition(':')
+        if backend_ip != ip or not status.get('checked'):
+            continue
+        if ports and backend_port not in ports:
+            continue
+        results.append(status.get('healthy', False))
+    if not results:
+        return None
+    return any(results)
+
 # Handle reverse proxy path prefix
 class ReverseProxied(object):
     def __init__(self, app):
@@ -257,6 +285,9 @@ DEVICES_FILE = '/opt/lpg/src/devices.json'
 if not os.path.exists(DEVICES_FILE):
     DEVICES_FILE = './devices.json'
 
+# プロキシ本体（デプロイ前の設定検査に使う）
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lpg-proxy.py')
+
 # 簡易認証設定(本番環境では環境変数から取得)
 ADMIN_USERNAME = os.environ.get('LPG_ADMIN_USER', 'admin')
 ADMIN_PASSWORD_HASH = hashlib.sha256(
@@ -567,11 +598,21 @@ def logs():
             with open(access_log, 'r') as f:
                 lines = f.readlines()
                 for line in lines[-20:]:  # 最新20行
-                    log_entries.append({
-                        'timestamp': datetime.now().isoformat(),
-                        'type': 'ACCESS',
-                        'message': line.strip()
-                    })
+                    # lpg-proxy は1行1レコードの JSON で出力する
+                    try:
+                        record = json.loads(line)
+                        log_entries.append({
+                            'timestamp': record.get('time', ''),
+                            'type': 'ACCESS',
+                            'message': f"{record.get('client')} {record.get('method')} {record.get('host')}{record.get('path')} "
+                                       f"{record.get('status')} -> {record.get('backend') or '-'} {record.get('total_time')}s"
+                        })
+                    except (ValueError, AttributeError):
+                        log_entries.append({
+                            'timestamp': datetime.now().isoformat(),
+                            'type': 'ACCESS',
+                            'message': line.strip()
+                        })
         
         # 時刻順にソート(新しいものが先)
         log_entries.sort(key=lambda x: x['timestamp'], reverse=True)
@@ -985,9 +1026,20 @@ def api_delete_device(domain, path):
 @app.route('/api/config/deploy', methods=['POST'])
 @login_required
 def api_deploy_config():
-    """設定をデプロイ(プロキシ再起動)"""
+    """設定をデプロイ(プロキシのグレースフルリロード)
+
+    ルート設定は稼働中のプロキシが自動で読み直すので、ここではキャッシュ容量などの
+    起動時オプションとコードの変更を反映する（待ち受けポートの変更には restart が必要）。
+    設定を検査してから systemctl reload で SIGHUP を送ると、新しいプロセスが待ち受けを
+    引き継ぎ、処理中の接続は旧プロセスが最後まで処理する。
+    """
     try:
-        # TODO: 実際のプロキシサーバー再起動処理
+        # Test configuration first
+        result = subprocess.run([sys.executable or 'python3', PROXY_SCRIPT, '--check'],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return jsonify({'status': 'error', 'message': result.stderr.strip()}), 400
+        subprocess.run(['systemctl', 'reload', 'lpg-proxy'], check=True)
         return jsonify({'status': 'success', 'message': 'Configuration deployed'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -1086,6 +1138,9 @@ def topology():
             'registration_path': domain.get('path', '/')
         })
     
+    # プロキシのヘルスチェック結果(pingの代わりに使用)
+    backend_health = fetch_proxy_status('/__lpg/health')
+    
     # devicesに追加情報を付与  
     total_access_count = 0
     for device in devices:
@@ -1111,10 +1166,13 @@ def topology():
         total_access_count += access_count
         
         # 追加のフィールド
+        ports = device.get('port', 80)
+        ports = ports if isinstance(ports, list) else [ports]
+        is_alive = get_backend_alive(backend_health, device.get('ip'), ports)
         device.update({
-            'ports': [device.get('port', 80)],
+            'ports': ports,
             'domain_id': 0,
-            'ping_status': device.get('ping_status', 'unknown'),
+            'ping_status': device.get('ping_status', 'unknown') if is_alive is None else ('online' if is_alive else 'offline'),
             'last_ping': device.get('last_ping', '')
         })
     
@@ -1160,6 +1218,20 @@ def api_ping_device(device_id):
         if not ip_address:
             return jsonify({'status': 'error', 'message': 'No IP address for device'}), 400
         
+        # プロキシがヘルスチェックしているデバイスはその結果を使う(pingを実行しない)
+        ports = device.get('port', [])
+        ports = ports if isinstance(ports, list) else [ports]
+        is_alive = get_backend_alive(fetch_proxy_status('/__lpg/health'), ip_address, ports)
+        if is_alive is not None:
+            return jsonify({
+                'status': 'success',
+                'device_id': device_id,
+                'ip_address': ip_address,
+                'is_alive': is_alive,
+                'source': 'health_check',
+                'timestamp': datetime.now().isoformat()
+            })
+        
         # ping実行(タイムアウト2秒、1回のみ)
         import subprocess
         try:
@@ -1193,6 +1265,15 @@ def api_ping_device(device_id):
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/proxy/health', methods=['GET'])
+@login_required
+def api_proxy_health():
+    """プロキシのバックエンドヘルスチェック結果"""
+    health = fetch_proxy_status('/__lpg/health')
+    if health is None:
+        return jsonify({'status': 'error', 'message': 'Proxy control endpoint unavailable'}), 503
+    return jsonify({'status': 'success', 'backends': health})
+
 @app.route('/api/network/connections', methods=['GET'])
 @login_required
 def api_get_network_connections():
@@ -1322,30 +1403,24 @@ def api_nginx_certificate_renew():
 @app.route('/api/nginx/cache/stats', methods=['GET'])
 @login_required
 def api_nginx_cache_stats():
-    """Get cache statistics"""
-    try:
-        import os
-        
-        # Calculate cache directory size (placeholder)
-        cache_dir = '/var/cache/nginx'
-        total_size = 0
-        
-        if os.path.exists(cache_dir):
-            for dirpath, dirnames, filenames in os.walk(cache_dir):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    if os.path.exists(fp):
-                        total_size += os.path.getsize(fp)
-        
-        size_mb = round(total_size / (1024 * 1024), 2)
-        
-        return jsonify({
-            'size': f'{size_mb} MB',
-            'hits': 0,  # Would need to parse nginx logs
-            'misses': 0  # Would need to parse nginx logs
-        })
-    except Exception as e:
-        return jsonify({'size': '0 MB', 'hits': 0, 'misses': 0})
+    """Get cache statistics from the LPG proxy (memory + disk)"""
+    stats = fetch_proxy_status('/__lpg/cache')
+    if stats is None:
+        return jsonify({'size': '0 MB', 'hits': 0, 'misses': 0, 'error': 'LPG proxy not reachable'})
+    
+    disk = stats.get('disk', {})
+    total_size = stats.get('size', 0) + disk.get('size', 0)
+    size_mb = round(total_size / (1024 * 1024), 2)
+    
+    return jsonify({
+        'size': f'{size_mb} MB',
+        'hits': stats.get('hits', 0) + disk.get('hits', 0),
+        'misses': stats.get('misses', 0),
+        'bypasses': stats.get('bypasses', 0),
+        'entries': stats.get('entries', 0) + disk.get('entries', 0),
+        'memory': {k: stats.get(k, 0) for k in ('entries', 'size', 'max_size', 'hits', 'evictions')},
+        'disk': disk
+    })
 
 @app.route('/api/nginx/cache/toggle', methods=['POST'])
 @login_required
@@ -1361,14 +1436,11 @@ def api_nginx_cache_toggle():
 @app.route('/api/nginx/cache/clear', methods=['POST'])
 @login_required
 def api_nginx_cache_clear():
-    """Clear nginx cache"""
-    try:
-        import subprocess
-        # Clear cache directory (be careful with permissions)
-        # subprocess.run(['rm', '-rf', '/var/cache/nginx/*'], shell=True)
-        return jsonify({'success': True, 'message': 'Cache cleared (feature limited)'})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+    """Clear the LPG proxy response cache (memory + disk)"""
+    result = fetch_proxy_status('/__lpg/cache/clear', method='POST')
+    if result is None:
+        return jsonify({'success': False, 'error': 'LPG proxy not reachable'}), 502
+    return jsonify({'success': True, 'message': 'Cache cleared'})
 
 @app.route('/api/nginx/reload', methods=['POST'])
 @login_required